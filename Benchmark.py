@@ -0,0 +1,218 @@
+import argparse
+import json
+import multiprocessing
+import numpy as np
+import resource
+import tempfile
+import time
+import tensorflow as tf
+
+from networks.GANWrapper import GAN, get_optimisers
+from utils.DataLoaders import ImgLoader, DiffAug
+
+
+""" Throughput benchmarks per scale on synthetic data:
+    - ImgLoader jpeg decode throughput
+    - DiffAug.augment cost
+    - GAN.train_step latency (p50/p95) and peak memory for each GAN type
+    - EMAGenerator inference throughput
+    Results are written as a JSON report to diff between releases """
+
+MODELS = ["original", "least_square", "wasserstein", "wasserstein-GP", "progressive"]
+
+DEFAULT_HYPERPARAMS = {
+    "LATENT_DIM": 128,
+    "MAX_RES": 64,
+    "NDF": 16,
+    "NGF": 16,
+    "MAX_CHANNELS": 128,
+    "EMA_BETA": 0.999,
+    "AUGMENT": False
+}
+
+
+def time_fn(fn, steps, warmup):
+    """ Returns per-call times in ms of fn, which must block until complete """
+
+    for _ in range(warmup):
+        fn()
+
+    times = []
+
+    for _ in range(steps):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+
+    return np.array(times)
+
+
+def summarise(times, batch_size):
+    return {
+        "ms_p50": float(np.percentile(times, 50)),
+        "ms_p95": float(np.percentile(times, 95)),
+        "img_per_sec": float(batch_size * 1000 / np.mean(times))
+    }
+
+
+def reset_peak_memory():
+    if tf.config.list_physical_devices("GPU"):
+        tf.config.experimental.reset_memory_stats("GPU:0")
+
+
+def peak_memory_mb():
+    """ Peak device memory if on GPU, otherwise peak process memory
+        (this never decreases, so each run is made in its own process) """
+
+    if tf.config.list_physical_devices("GPU"):
+        return tf.config.experimental.get_memory_info("GPU:0")["peak"] / 2 ** 20
+    else:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def write_synthetic_jpegs(file_path, num_images, res):
+    """ Writes random noise jpegs so ImgLoader can be run without a dataset """
+
+    for i in range(num_images):
+        img = tf.random.uniform([res, res, 3], 0, 256, dtype=tf.int32)
+        tf.io.write_file(f"{file_path}{i:05d}.jpg", tf.io.encode_jpeg(tf.cast(img, tf.uint8)))
+
+
+def benchmark_decode(file_path, num_images, res, batch_size):
+    """ Images/sec decoded, resized and batched by ImgLoader 'parallel' pipeline """
+
+    loader = ImgLoader({"DATA_PATH": file_path, "DATASET_SIZE": num_images, "LOADER": "parallel"})
+    ds = loader.dataset(res, batch_size)
+
+    # First pass excluded to warm up file cache and pipeline
+    for _ in ds: pass
+    start = time.perf_counter()
+    count = 0
+
+    for imgs in ds:
+        count += imgs.shape[0]
+
+    return {"img_per_sec": float(count / (time.perf_counter() - start))}
+
+
+def benchmark_augment(res, batch_size, steps, warmup):
+    """ Latency of DiffAug.augment with all augmentations on a batch """
+
+    Aug = DiffAug({"colour": True, "translation": True, "cutout": True})
+    imgs = tf.random.uniform([batch_size, res, res, 3], -1, 1)
+    augment = tf.function(Aug.augment)
+
+    times = time_fn(lambda: augment(imgs).numpy(), steps, warmup)
+
+    return summarise(times, batch_size)
+
+
+def benchmark_scale(config, GAN_type, scale_idx, mb_size, steps, warmup):
+    """ Train step latency, peak memory and EMAGenerator throughput at one scale
+        - img_per_sec counts real images consumed i.e. mb_size * n_critic per step """
+
+    res = 4 * 2 ** scale_idx
+    config = dict(config, MODEL=GAN_type)
+    g_optimiser, d_optimiser, n_critic = get_optimisers(GAN_type)
+    Model = GAN(config=config, g_optimiser=g_optimiser, d_optimiser=d_optimiser, n_critic=n_critic)
+    Model.fade_set(0)
+    Model.build_scale(scale_idx)
+    Model.set_trainable_layers(scale_idx)
+
+    real_images = tf.random.uniform([mb_size * n_critic, res, res, 3], -1, 1)
+
+    # Reading metric blocks until step has completed
+    def train_step():
+        Model.train_step(real_images, scale=scale_idx)
+        Model.metric_dict["g_metric"].result().numpy()
+
+    reset_peak_memory()
+    times = time_fn(train_step, steps, warmup)
+    results = summarise(times, mb_size * n_critic)
+    results["peak_memory_mb"] = float(peak_memory_mb())
+
+    latent_noise = tf.random.normal([mb_size, config["LATENT_DIM"]])
+    sample = tf.function(lambda x: Model.EMAGenerator(x, scale_idx, training=False))
+    ema_times = time_fn(lambda: sample(latent_noise).numpy(), steps, warmup)
+    results["ema_img_per_sec"] = summarise(ema_times, mb_size)["img_per_sec"]
+
+    return results
+
+
+def run_isolated(fn, *args):
+    """ Runs fn(*args) in a fresh process and returns its result, so that
+        peak process memory is measured per run rather than accumulated """
+
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(fn, args)
+
+
+def benchmark_model(config, GAN_type, scales, mb_size, steps, warmup):
+    """ Benchmarks GAN type at each scale, each in a separate process """
+
+    results = {}
+
+    for scale_idx, res in enumerate(scales):
+        results[res] = run_isolated(benchmark_scale, config, GAN_type, scale_idx, mb_size, steps, warmup)
+        print(f"{GAN_type} {res}: train p50 {results[res]['ms_p50']:.2f} ms, p95 {results[res]['ms_p95']:.2f} ms, EMA {results[res]['ema_img_per_sec']:.1f} img/s")
+
+    return results
+
+
+if __name__ == "__main__":
+
+    # Handle arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config_path", "-cp", help="Config json path, HYPERPARAMS used if given", type=str, default=None)
+    parser.add_argument("--models", "-m", help="GAN types to benchmark", nargs="+", default=MODELS)
+    parser.add_argument("--mb_size", "-mb", help="Minibatch size", type=int, default=16)
+    parser.add_argument("--accum_steps", "-a", help="Micro-batches per minibatch, overrides ACCUM_STEPS", type=int, default=None)
+    parser.add_argument("--steps", "-s", help="Timed steps per benchmark", type=int, default=20)
+    parser.add_argument("--warmup", "-w", help="Untimed steps per benchmark", type=int, default=3)
+    parser.add_argument("--num_images", "-n", help="Synthetic jpegs for decode benchmark", type=int, default=256)
+    parser.add_argument("--output", "-o", help="JSON report path", type=str, default="benchmark.json")
+    arguments = parser.parse_args()
+
+    if arguments.config_path:
+        with open(arguments.config_path, 'r') as infile:
+            HYPERPARAMS = json.load(infile)["HYPERPARAMS"]
+    else:
+        HYPERPARAMS = DEFAULT_HYPERPARAMS
+
+    if arguments.accum_steps:
+        HYPERPARAMS = dict(HYPERPARAMS, ACCUM_STEPS=arguments.accum_steps)
+
+    SCALES = [4 * 2 ** i for i in range(int(np.log2(HYPERPARAMS["MAX_RES"])) - 1)]
+
+    report = {
+        "meta": {
+            "tf_version": tf.__version__,
+            "devices": [device.name for device in tf.config.list_logical_devices()],
+            "precision": HYPERPARAMS.get("PRECISION", "float32"),
+            "mb_size": arguments.mb_size,
+            "steps": arguments.steps,
+            "hyperparams": HYPERPARAMS
+        },
+        "decode": {},
+        "augment": {},
+        "models": {}
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_synthetic_jpegs(f"{tmp_dir}/", arguments.num_images, HYPERPARAMS["MAX_RES"])
+
+        for res in SCALES:
+            report["decode"][res] = benchmark_decode(f"{tmp_dir}/", arguments.num_images, res, arguments.mb_size)
+            print(f"Decode {res}: {report['decode'][res]['img_per_sec']:.1f} img/s")
+
+    for res in SCALES:
+        report["augment"][res] = benchmark_augment(res, arguments.mb_size, arguments.steps, arguments.warmup)
+        print(f"Augment {res}: p50 {report['augment'][res]['ms_p50']:.2f} ms")
+
+    for GAN_type in arguments.models:
+        report["models"][GAN_type] = benchmark_model(HYPERPARAMS, GAN_type, SCALES, arguments.mb_size, arguments.steps, arguments.warmup)
+
+    with open(arguments.output, 'w') as outfile:
+        json.dump(report, outfile, indent=4)
+
+    print(f"Report written to {arguments.output}")
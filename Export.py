@@ -0,0 +1,45 @@
+import argparse
+import json
+import tensorflow as tf
+
+from utils.Checkpoints import read_checkpoint_meta
+from utils.Sampling import load_ema_generator, export_generator
+
+
+""" Exports EMA generator from a training checkpoint as a SavedModel
+    for the checkpointed scale - lower scales' to_rgb layers are frozen
+    while later blocks keep training, so they can't be exported from a
+    later checkpoint (set EXPORT_SCALES to export each scale as it finishes) """
+
+# Handle arguments
+parser = argparse.ArgumentParser()
+parser.add_argument("--config_path", "-cp", help="Config json path", type=str)
+parser.add_argument("--checkpoint", "-ck", help="Checkpoint path, latest if not given", type=str, default=None)
+parser.add_argument("--save_path", "-sp", help="Export directory", type=str, default=None)
+arguments = parser.parse_args()
+
+# Parse config json
+with open(arguments.config_path, 'r') as infile:
+    CONFIG = json.load(infile)
+
+if arguments.checkpoint:
+    CHECKPOINT = arguments.checkpoint
+else:
+    CHECKPOINT = tf.train.latest_checkpoint(f"{CONFIG['EXPT']['SAVE_PATH']}models/{CONFIG['EXPT']['EXPT_NAME']}/")
+
+if arguments.save_path:
+    SAVE_PATH = arguments.save_path
+else:
+    SAVE_PATH = f"{CONFIG['EXPT']['SAVE_PATH']}export/{CONFIG['EXPT']['EXPT_NAME']}/"
+
+meta = read_checkpoint_meta(CHECKPOINT)
+EMAGenerator = load_ema_generator(CONFIG["HYPERPARAMS"], CHECKPOINT, meta["scale_idx"])
+
+# Current scale may be part way through fade in or stabilise phase
+SCALE = CONFIG["EXPT"]["SCALES"][meta["idx"]]
+
+if not meta["fade"] and meta["epoch"] >= CONFIG["EXPT"]["EPOCHS"][meta["idx"]]:
+    export_generator(EMAGenerator, f"{SAVE_PATH}{SCALE}/", meta["scale_idx"], CONFIG["HYPERPARAMS"]["LATENT_DIM"])
+    print(f"Exported scale {SCALE} to {SAVE_PATH}{SCALE}/")
+else:
+    print(f"Skipped scale {SCALE}: {'fade in' if meta['fade'] else 'stabilise'} phase unfinished (epoch {meta['epoch']})")
@@ -0,0 +1,50 @@
+import argparse
+import json
+
+from utils.DataLoaders import ImgLoader, VolLoader
+from utils.ImageQuality import ImageQuality, dataset_diversity
+from utils.Sampling import Sampler
+
+
+""" MS-SSIM/PSNR between pairs of images sampled from a generator
+    exported by Export.py, optionally with real image pairs from the
+    dataset in config as a baseline - results written as JSON """
+
+# Handle arguments
+parser = argparse.ArgumentParser()
+parser.add_argument("--model_path", "-mp", help="Exported SavedModel for one scale", type=str)
+parser.add_argument("--config_path", "-cp", help="Config json path, for real image baseline", type=str, default=None)
+parser.add_argument("--num_pairs", "-n", help="Number of image pairs", type=int, default=2048)
+parser.add_argument("--batch_size", "-bs", help="Pairs per batch", type=int, default=64)
+parser.add_argument("--seed", "-s", help="Latent noise seed", type=int, default=None)
+parser.add_argument("--output", "-o", help="JSON results path", type=str, default=None)
+arguments = parser.parse_args()
+
+ModelSampler = Sampler(arguments.model_path)
+quality = None
+
+for imgs in ModelSampler.sample(2 * arguments.num_pairs, batch_size=2 * arguments.batch_size, seed=arguments.seed):
+    if quality is None: quality = ImageQuality(imgs.shape[1])
+    n = imgs.shape[0] // 2
+    quality.update(imgs[0:n], imgs[n:2 * n])
+
+results = {"generated": quality.result()}
+res = imgs.shape[1]
+
+if arguments.config_path:
+    with open(arguments.config_path, 'r') as infile:
+        CONFIG = json.load(infile)
+
+    if CONFIG["EXPT"].get("LOADER") == "volume":
+        DataLoader = VolLoader(CONFIG["EXPT"])
+    else:
+        DataLoader = ImgLoader(CONFIG["EXPT"])
+
+    results["real"] = dataset_diversity(DataLoader.dataset(res, 2 * arguments.batch_size), res, arguments.num_pairs)
+
+for name, result in results.items():
+    print(f"{name}: MS-SSIM {result['ms_ssim']['mean']:.4f} (p5 {result['ms_ssim']['p5']:.4f}, p95 {result['ms_ssim']['p95']:.4f}), PSNR {result['psnr']['mean']:.2f}")
+
+if arguments.output:
+    with open(arguments.output, 'w') as outfile:
+        json.dump(results, outfile, indent=4)
@@ -4,20 +4,22 @@ import matplotlib.pyplot as plt
 import numpy as np
 import os
 import sys
-import tensorflow.keras as keras
 import tensorflow as tf
 
 from TrainingLoops import training_loop, trace_graph, print_model_summary
-from networks.GANWrapper import GAN
-from utils.DataLoaders import ImgLoader, DiffAug
+from networks.GANWrapper import GAN, get_optimisers
+from utils.Checkpoints import Checkpointer
+from utils.DataLoaders import ImgLoader, VolLoader, DiffAug
+from utils.Distribute import get_strategy, is_chief
+from utils.Evaluation import Evaluator
+from utils.Profiler import StepProfiler
+from utils.SampleWriter import SampleWriter
 
 
 """ Based on:
     - Karras et al. Progressive Growing of GANs for Improved Quality, Stability, and Variation
     - https://arxiv.org/abs/1710.10196 """
 
-# TODO: MS-SSIM
-# TODO: data aug prob
 # TODO: Linear in place of tanh
 # TODO: truncation trick
 
@@ -30,78 +32,104 @@ arguments = parser.parse_args()
 with open(arguments.config_path, 'r') as infile:
     CONFIG = json.load(infile)
 
-# Set GAN-specific optimisers/hyperparameters
-# TODO: move into GANWrapper
-OPT_DICT = {
-    "original": {
-        "G_OPT": keras.optimizers.Adam(2e-4, 0.5, 0.999),
-        "D_OPT": keras.optimizers.Adam(2e-4, 0.5, 0.999),
-        "N_CRITIC": 1
-        },
-    "least_square": {
-        "G_OPT": keras.optimizers.Adam(2e-4, 0.5, 0.999),
-        "D_ETA": keras.optimizers.Adam(2e-4, 0.5, 0.999),
-        "N_CRITIC": 1
-        },
-    "wasserstein": {
-        "G_OPT": keras.optimizers.RMSprop(5e-5),
-        "D_OPT": keras.optimizers.RMSprop(5e-5),
-        "N_CRITIC": 5
-        },
-    "wasserstein-GP": {
-        "G_OPT": keras.optimizers.Adam(1e-4, 0.0, 0.9),
-        "D_OPT": keras.optimizers.Adam(1e-4, 0.0, 0.9),
-        "N_CRITIC": 5
-    },
-    "progressive": {
-        "G_OPT": keras.optimizers.Adam(1e-3, 0.0, 0.99),
-        "D_OPT": keras.optimizers.Adam(1e-3, 0.0, 0.99),
-        "N_CRITIC": 1
-    }
-}
+# Strategy must be set up before any other TensorFlow ops
+Strategy = get_strategy(CONFIG["EXPT"])
 
 LATENT_SAMPLE = tf.random.normal([CONFIG["EXPT"]["NUM_EXAMPLES"], CONFIG["HYPERPARAMS"]["LATENT_DIM"]], dtype=tf.float32)
 
-# Create optimisers and compile model
-Model = GAN(
-    config=CONFIG["HYPERPARAMS"],
-    g_optimiser=OPT_DICT[CONFIG["HYPERPARAMS"]["MODEL"]]["G_OPT"],
-    d_optimiser=OPT_DICT[CONFIG["HYPERPARAMS"]["MODEL"]]["D_OPT"],
-    n_critic=OPT_DICT[CONFIG["HYPERPARAMS"]["MODEL"]]["N_CRITIC"]
-    )
-
-# trace_graph(Model.Generator, tf.zeros((1, 128)))
-# trace_graph(Model.Discriminator, tf.zeros((1, 64, 64, 3)))
+# Create optimisers and model inside strategy scope so variables are mirrored across replicas
+with Strategy.scope():
+    G_OPT, D_OPT, N_CRITIC = get_optimisers(CONFIG["HYPERPARAMS"]["MODEL"])
+
+    Model = GAN(
+        config=CONFIG["HYPERPARAMS"],
+        g_optimiser=G_OPT,
+        d_optimiser=D_OPT,
+        n_critic=N_CRITIC
+        )
+
+LOG_SAVE_PATH = f"{CONFIG['EXPT']['SAVE_PATH']}logs/{CONFIG['EXPT']['EXPT_NAME']}/"
+# trace_graph(Model.Generator, tf.zeros((1, 128)), LOG_SAVE_PATH, scale=4)
+# trace_graph(Model.Discriminator, tf.zeros((1, 64, 64, 3)), LOG_SAVE_PATH, scale=4)
+# Summary needs all weights so builds networks up to MAX_RES
 if CONFIG["EXPT"]["VERBOSE"]:
+    Model.build_scale(Model.Generator.num_layers - 1)
     print_model_summary(Model.Generator, CONFIG["HYPERPARAMS"]["MAX_RES"])
     print_model_summary(Model.Discriminator, CONFIG["HYPERPARAMS"]["MAX_RES"])
 
 # Set up dataset with minibatch size multiplied by number of critic training runs
-DataLoader = ImgLoader(CONFIG["EXPT"])
+if CONFIG["EXPT"].get("LOADER") == "volume":
+    DataLoader = VolLoader(CONFIG["EXPT"])
+else:
+    DataLoader = ImgLoader(CONFIG["EXPT"])
+
+# Progression of (scale index, fade) training phases
+PHASES = [(0, False)] + [(i, fade) for i in range(1, len(CONFIG["EXPT"]["SCALES"])) for fade in [True, False]]
+start_phase, start_epoch = 0, 0
 
-if CONFIG["EXPT"]["FROM_RAM"]:
-    train_ds = tf.data.Dataset.from_tensor_slices(
-        DataLoader.data_loader(res=CONFIG["EXPT"]["SCALES"][0])
-        ).batch(CONFIG["EXPT"]["MB_SIZE"][0] * OPT_DICT[CONFIG["HYPERPARAMS"]["MODEL"]]["N_CRITIC"])
+# Set up checkpointing and resume from latest checkpoint if required
+if CONFIG["EXPT"].get("CKPT_EVERY") or CONFIG["EXPT"].get("RESUME"):
+    ModelCheckpointer = Checkpointer(
+        Model, f"{CONFIG['EXPT']['SAVE_PATH']}models/{CONFIG['EXPT']['EXPT_NAME']}/",
+        max_to_keep=CONFIG["EXPT"].get("CKPT_KEEP", 3))
 else:
-    train_ds = tf.data.Dataset.from_generator(
-        DataLoader.data_generator,
-        args=[CONFIG["EXPT"]["SCALES"][0]], output_types=tf.float32
-        ).batch(CONFIG["EXPT"]["MB_SIZE"][0] * OPT_DICT[CONFIG["HYPERPARAMS"]["MODEL"]]["N_CRITIC"]).prefetch(CONFIG["EXPT"]["MB_SIZE"][0])
-
-Model = training_loop(CONFIG["EXPT"], idx=0, Model=Model, data=train_ds, latent_sample=LATENT_SAMPLE, fade=False)
-
-for i in range(1, len(CONFIG["EXPT"]["SCALES"])):
-
-    if CONFIG["EXPT"]["FROM_RAM"]:
-        train_ds = tf.data.Dataset.from_tensor_slices(
-            DataLoader.data_loader(res=CONFIG["EXPT"]["SCALES"][i])
-            ).batch(CONFIG["EXPT"]["MB_SIZE"][i] * OPT_DICT[CONFIG["HYPERPARAMS"]["MODEL"]]["N_CRITIC"])
-    else:
-        train_ds = tf.data.Dataset.from_generator(
-            DataLoader.data_generator,
-            args=[CONFIG["EXPT"]["SCALES"][i]], output_types=tf.float32
-            ).batch(CONFIG["EXPT"]["MB_SIZE"][i] * OPT_DICT[CONFIG["HYPERPARAMS"]["MODEL"]]["N_CRITIC"]).prefetch(CONFIG["EXPT"]["MB_SIZE"][i])
-
-    Model = training_loop(CONFIG["EXPT"], idx=i, Model=Model, data=train_ds, latent_sample=LATENT_SAMPLE, fade=True)
-    Model = training_loop(CONFIG["EXPT"], idx=i, Model=Model, data=train_ds, latent_sample=LATENT_SAMPLE, fade=False)
+    ModelCheckpointer = None
+
+if CONFIG["EXPT"].get("RESUME"):
+    meta = ModelCheckpointer.restore()
+
+    if meta is not None:
+        start_phase = PHASES.index((meta["idx"], meta["fade"]))
+        start_epoch = meta["epoch"]
+
+        # Move to next phase if checkpointed phase was completed
+        if start_epoch >= CONFIG["EXPT"]["EPOCHS"][meta["idx"]]:
+            start_phase += 1
+            start_epoch = 0
+
+        print(f"Resuming at scale {CONFIG['EXPT']['SCALES'][meta['idx']]} fade {meta['fade']} epoch {meta['epoch']}")
+
+ImageWriter = SampleWriter(max_queue=CONFIG["EXPT"].get("SAMPLE_QUEUE", 2))
+
+# Step count continues from checkpoint if resuming
+TrainProfiler = StepProfiler(
+    LOG_SAVE_PATH,
+    log_every=CONFIG["EXPT"].get("LOG_EVERY", 100),
+    profile_steps=CONFIG["EXPT"].get("PROFILE_STEPS"),
+    initial_step=int(Model.g_optimiser.iterations.numpy()))
+
+# FID/KID of EMA generator scored every FID_EVERY epochs if set
+if CONFIG["EXPT"].get("FID_EVERY"):
+    ModelEvaluator = Evaluator(CONFIG["EXPT"], DataLoader)
+else:
+    ModelEvaluator = None
+
+# All workers restore, but only the chief writes checkpoints if training across hosts
+SaveCheckpointer = ModelCheckpointer if is_chief() else None
+
+# EMA generator exported per scale as each finishes if EXPORT_SCALES set
+if CONFIG["EXPT"].get("EXPORT_SCALES") and is_chief():
+    EXPORT_PATH = f"{CONFIG['EXPT']['SAVE_PATH']}export/{CONFIG['EXPT']['EXPT_NAME']}/"
+else:
+    EXPORT_PATH = None
+
+ds_idx = None
+
+for i, fade in PHASES[start_phase:]:
+
+    # Fade in and stabilise phases of a scale share a dataset
+    # (MB_SIZE is the global minibatch, split evenly across replicas)
+    if i != ds_idx:
+        assert CONFIG["EXPT"]["MB_SIZE"][i] % Strategy.num_replicas_in_sync == 0, "Minibatch size must be divisible by number of replicas"
+        assert Strategy.num_replicas_in_sync == 1 or (CONFIG["EXPT"]["MB_SIZE"][i] // Strategy.num_replicas_in_sync) % 4 == 0, \
+            "Per-replica minibatch size must be a multiple of minibatch stddev group size 4"
+        train_ds = DataLoader.dataset(res=CONFIG["EXPT"]["SCALES"][i], batch_size=CONFIG["EXPT"]["MB_SIZE"][i] * N_CRITIC)
+        if Strategy.num_replicas_in_sync > 1: train_ds = Strategy.experimental_distribute_dataset(train_ds)
+        ds_idx = i
+
+    Model = training_loop(CONFIG["EXPT"], idx=i, Model=Model, data=train_ds, latent_sample=LATENT_SAMPLE, fade=fade, start_epoch=start_epoch, Checkpointer=SaveCheckpointer, Writer=ImageWriter, Profiler=TrainProfiler, Evaluator=ModelEvaluator, export_path=EXPORT_PATH)
+    start_epoch = 0
+
+ImageWriter.close()
+TrainProfiler.close()
+if ModelCheckpointer is not None: ModelCheckpointer.close()
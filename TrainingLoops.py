@@ -1,18 +1,23 @@
 import datetime
-import matplotlib.pyplot as plt
 import numpy as np
 import os
 import tensorflow as tf
 
+from utils.ImageQuality import sample_diversity
+from utils.Profiler import StepProfiler
+from utils.SampleWriter import SampleWriter
+from utils.Sampling import export_generator
 
-def trace_graph(model, input_zeros):
+
+def trace_graph(model, input_zeros, log_path, scale=0):
+    """ Exports graph of model at scale to TensorBoard under log_path """
 
     @tf.function
     def trace(x):
-        return model(x, 4)
+        return model(x, scale)
 
     current_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-    log_dir = "C:/Users/roybo/OneDrive - University College London/PhD/PhD_Prog/009_GAN_CT/logs/" + current_time
+    log_dir = f"{log_path}graph/{current_time}"
     summary_writer = tf.summary.create_file_writer(log_dir)
 
     tf.summary.trace_on(graph=True)
@@ -30,19 +35,24 @@ def print_model_summary(model, res):
     weights = []
     total_weights = 0
 
-    for weight in model.layers[-1].weights:
-        if len(weight.shape) > 1: weights.append(weight.shape.as_list())
-        total_weights += np.prod(weight.shape.as_list())
+    for idx, block in enumerate(model.blocks):
+        for weight in block.weights:
+            if len(weight.shape) > 1: weights.append((weight.shape.as_list(), 4 * 2 ** idx))
+            total_weights += np.prod(weight.shape.as_list())
 
-    for idx, weight in enumerate(weights):
-        print(f"{weight} resolution {res // 2 ** idx}")
+    for weight, block_res in weights:
+        print(f"{weight} resolution {block_res}")
 
     print("===================================")
     print(f"Total weights: {total_weights}")
     print("===================================")
 
 
-def training_loop(config, idx, Model, data, latent_sample, fade=False):
+def training_loop(config, idx, Model, data, latent_sample, fade=False, start_epoch=0, Checkpointer=None, Writer=None, Profiler=None, Evaluator=None, export_path=None):
+    """ Trains one phase (fade in or stabilise) of scale idx
+        - export_path: if given, EMA generator is exported here as a SavedModel
+          when stabilise phase ends, while this scale's to_rgb is current """
+
     SCALE = config["SCALES"][idx]
     EPOCHS = config["EPOCHS"][idx]
 
@@ -51,7 +61,7 @@ def training_loop(config, idx, Model, data, latent_sample, fade=False):
     LOG_SAVE_PATH = f"{config['SAVE_PATH']}logs/{config['EXPT_NAME']}/"
     if not os.path.exists(LOG_SAVE_PATH): os.mkdir(LOG_SAVE_PATH)
     MODEL_SAVE_PATH = f"{config['SAVE_PATH']}models/{config['EXPT_NAME']}/"
-    if not os.path.exists(IMG_SAVE_PATH): os.mkdir(MODEL_SAVE_PATH)
+    if not os.path.exists(MODEL_SAVE_PATH): os.mkdir(MODEL_SAVE_PATH)
 
     if fade:
         num_batches = config["DATASET_SIZE"] // config["MB_SIZE"][idx]
@@ -59,49 +69,103 @@ def training_loop(config, idx, Model, data, latent_sample, fade=False):
     else:
         num_iter = 0
     
-    Model.fade_set(num_iter)
+    # Fade count is restored from checkpoint if resuming mid-phase
+    Model.fade_set(num_iter, reset=start_epoch == 0)
 
     scale_idx = int(np.log2(SCALE / 4))
 
+    Model.build_scale(scale_idx)
     Model.set_trainable_layers(scale_idx)
 
-    for epoch in range(EPOCHS):
+    # Sample images are written off the training thread
+    if Writer is None:
+        loop_writer = SampleWriter()
+    else:
+        loop_writer = Writer
+
+    # Phase timings and metrics are written to TensorBoard
+    if Profiler is None:
+        loop_profiler = StepProfiler(LOG_SAVE_PATH, log_every=config.get("LOG_EVERY", 100), profile_steps=config.get("PROFILE_STEPS"))
+    else:
+        loop_profiler = Profiler
+
+    # Real images consumed per training step
+    batch_size = config["MB_SIZE"][idx] * Model.n_critic
+
+    # Stabilise phase stops early if FID has not improved by FID_MIN_DELTA in FID_PATIENCE evaluations
+    best_fid = np.inf
+    evals_since_best = 0
+
+    for epoch in range(start_epoch, EPOCHS):
 
         Model.metric_dict["g_metric"].reset_states()
         Model.metric_dict["d_metric_1"].reset_states()
         Model.metric_dict["d_metric_2"].reset_states()
 
-        for imgs in data:
-            if np.random.rand() > 0.5: imgs = imgs[:, :, ::-1, :]
-            _ = Model.train_step(imgs, scale=scale_idx)
+        data_iter = iter(data)
+
+        while True:
+            with loop_profiler.timer("data_wait"):
+                imgs = next(data_iter, None)
+
+            if imgs is None: break
+
+            timings = Model.train_step(imgs, scale=scale_idx)
+            loop_profiler.record_step(timings, batch_size, Model)
+
+        loop_profiler.flush(Model)
 
         print(f"Scale {SCALE} Fade {fade} Ep {epoch + 1}, G: {Model.metric_dict['g_metric'].result():.4f}, D1: {Model.metric_dict['d_metric_1'].result():.4f}, D2: {Model.metric_dict['d_metric_2'].result():.4f}")
+        if Model.ADA: print(f"Augmentation p: {Model.Aug.p.numpy():.3f}")
 
         # Generate example images
         if (epoch + 1) % 1 == 0 and not fade:
-            pred = Model.EMAGenerator(latent_sample, scale=scale_idx, training=False)
-
-            fig = plt.figure(figsize=(4,4))
-
-            for i in range(pred.shape[0]):
-                plt.subplot(4, 4, i+1)
-                plt.imshow(pred[i, :, :, :] / 2 + 0.5)
-                plt.axis('off')
-
-            plt.tight_layout()
-            plt.savefig(f"{IMG_SAVE_PATH}{scale_idx}_scale_{SCALE}_epoch_{epoch + 1:02d}.png", dpi=250)
-            plt.close()
-
-        # Save checkpoint
-        # if (epoch + 1) % 10 == 0 and SAVE_CKPT:
-        #     check_path = f"{SAVE_PATH}models/{RES}/"
-
-        #     if not os.path.exists(check_path):
-        #         os.mkdir(check_path)
-            
-        #     G_check_name = f"{SAVE_PATH}models/{RES}/G_{epoch + 1:04d}.ckpt"
-        #     D_check_name = f"{SAVE_PATH}models/{RES}/D_{epoch + 1:04d}.ckpt"
-        #     Generator.save_weights(G_check_name)
-        #     Discriminator.save_weights(D_check_name)
+            with loop_profiler.timer("sample_render"):
+                pred = Model.EMAGenerator(latent_sample, scale=scale_idx, training=False)
+                loop_writer.write(pred, f"{IMG_SAVE_PATH}{scale_idx}_scale_{SCALE}_epoch_{epoch + 1:02d}.png")
+
+        # MS-SSIM/PSNR between pairs of EMA generator samples every MSSSIM_EVERY epochs
+        if config.get("MSSSIM_EVERY") and not fade and (epoch + 1) % config["MSSSIM_EVERY"] == 0:
+            with loop_profiler.timer("evaluation"):
+                quality = sample_diversity(Model.EMAGenerator, scale_idx, SCALE, Model.latent_dims, num_pairs=config.get("MSSSIM_PAIRS", 512))
+
+            loop_profiler.log_scalars({f"eval/{name}_{SCALE}": value["mean"] for name, value in quality.items()})
+            print(f"Scale {SCALE} Ep {epoch + 1}, MS-SSIM: {quality['ms_ssim']['mean']:.4f}, PSNR: {quality['psnr']['mean']:.2f}")
+
+        # Score EMA generator every FID_EVERY epochs
+        converged = False
+
+        if Evaluator is not None and not fade and (epoch + 1) % config["FID_EVERY"] == 0:
+            with loop_profiler.timer("evaluation"):
+                scores = Evaluator.score(Model.EMAGenerator, scale_idx, SCALE, Model.latent_dims)
+
+            loop_profiler.log_scalars({f"eval/{name}_{SCALE}": value for name, value in scores.items()})
+            print(f"Scale {SCALE} Ep {epoch + 1}, FID: {scores['fid']:.4f}, KID: {scores['kid']:.6f}")
+
+            if scores["fid"] < best_fid - config.get("FID_MIN_DELTA", 0.0):
+                best_fid = scores["fid"]
+                evals_since_best = 0
+            else:
+                evals_since_best += 1
+
+            if config.get("FID_PATIENCE") and evals_since_best >= config["FID_PATIENCE"]:
+                print(f"Scale {SCALE} converged at epoch {epoch + 1}")
+                converged = True
+
+        # Save checkpoint every CKPT_EVERY epochs and at end of phase
+        # (saved as completed phase if converged, so resuming moves to next phase)
+        if Checkpointer is not None and config.get("CKPT_EVERY"):
+            if (epoch + 1) % config["CKPT_EVERY"] == 0 or epoch + 1 == EPOCHS or converged:
+                with loop_profiler.timer("checkpoint"):
+                    Checkpointer.save(idx, scale_idx, fade, EPOCHS if converged else epoch + 1)
+
+        if converged: break
+
+    if export_path is not None and not fade:
+        export_generator(Model.EMAGenerator, f"{export_path}{SCALE}/", scale_idx, Model.latent_dims)
+        print(f"Exported scale {SCALE} to {export_path}{SCALE}/")
+
+    if Writer is None: loop_writer.close()
+    if Profiler is None: loop_profiler.close()
     
     return Model
\ No newline at end of file
@@ -2,10 +2,27 @@ import tensorflow as tf
 import tensorflow.keras as keras
 
 from networks.Networks import Discriminator, Generator
-from utils.TrainFuncs import least_square_loss, wasserstein_loss, gradient_penalty
+from utils.TrainFuncs import least_square_loss, wasserstein_loss, gradient_penalty, penalty_from_gradients, EMA, ADA
 from utils.DataLoaders import DiffAug
 
 
+def get_optimisers(GAN_type):
+    """ Returns GAN-specific generator optimiser, discriminator
+        optimiser and number of critic training runs
+        - create inside strategy scope if distributed """
+
+    if GAN_type in ["original", "least_square"]:
+        return keras.optimizers.Adam(2e-4, 0.5, 0.999), keras.optimizers.Adam(2e-4, 0.5, 0.999), 1
+    elif GAN_type == "wasserstein":
+        return keras.optimizers.RMSprop(5e-5), keras.optimizers.RMSprop(5e-5), 5
+    elif GAN_type == "wasserstein-GP":
+        return keras.optimizers.Adam(1e-4, 0.0, 0.9), keras.optimizers.Adam(1e-4, 0.0, 0.9), 5
+    elif GAN_type == "progressive":
+        return keras.optimizers.Adam(1e-3, 0.0, 0.99), keras.optimizers.Adam(1e-3, 0.0, 0.99), 1
+    else:
+        raise ValueError(f"Invalid GAN type: {GAN_type}")
+
+
 class GAN(keras.Model):
 
     """ GAN class
@@ -15,13 +32,35 @@ class GAN(keras.Model):
         - g_optimiser: generator optimiser e.g. keras.optimizers.Adam()
         - d_optimiser: discriminator optimiser e.g. keras.optimizers.Adam()
         - GAN_type: 'original', 'least_square', 'wasserstein' or 'wasserstein-GP'
-        - n_critic: number of discriminator/critic training runs (5 in WGAN, 1 otherwise) """
+        - n_critic: number of discriminator/critic training runs (5 in WGAN, 1 otherwise)
+        - PRECISION: 'float32' (default), 'mixed_float16' or 'mixed_bfloat16'
+        - AUG_PROB: probability each sample is augmented if AUGMENT set (default 1.0)
+        - ACCUM_STEPS: number of micro-batches each minibatch is split into,
+          with gradients accumulated to reduce activation memory (default 1) -
+          micro-batch size must be a multiple of minibatch stddev group size 4
+        - ADA: adapt augmentation probability (starting from AUG_PROB, default 0.0)
+          every ADA_EVERY steps so E[sign(D(real))] tracks ADA_TARGET
+
+        If created inside a tf.distribute.Strategy scope, training is data
+        parallel across that strategy's replicas """
 
     def __init__(self, config, g_optimiser, d_optimiser, n_critic):
         super(GAN, self).__init__()
+
+        # Weights built lazily later must be created in the same scope
+        self.strategy = tf.distribute.get_strategy()
         self.latent_dims = config["LATENT_DIM"]
         self.GAN_type = config["MODEL"]
 
+        # Mixed precision policy must be set before networks are built
+        precision = config.get("PRECISION", "float32")
+        keras.mixed_precision.set_global_policy(precision)
+        self.loss_scaling = precision == "mixed_float16"
+
+        if self.loss_scaling:
+            g_optimiser = keras.mixed_precision.LossScaleOptimizer(g_optimiser)
+            d_optimiser = keras.mixed_precision.LossScaleOptimizer(d_optimiser)
+
         # Choose appropriate loss and initialise metrics
         self.loss_dict = {
             "original": keras.losses.BinaryCrossentropy(from_logits=True),
@@ -58,8 +97,24 @@ class GAN(keras.Model):
             self.d_fake_label = 1.0
             self.g_label = 0.0
             cons = False
+        # Orient critic predictions for real images so positive means predicted real,
+        # as ADA heuristic requires (logits for 'original', targets 0/1 for 'least_square')
+        if self.GAN_type == "original":
+            self.realness = lambda d_pred: -d_pred
+        elif self.GAN_type == "least_square":
+            self.realness = lambda d_pred: 0.5 - d_pred
+        else:
+            self.realness = lambda d_pred: d_pred
+
         # TODO: IMPLEMENT CONSTRAINT TYPE
         self.loss = self.loss_dict[self.GAN_type]
+        self.grad_penalty = self.GAN_type in ["wasserstein-GP", "progressive"]
+
+        # Pass real, fake and interpolated images through critic in one call
+        self.batched_critic = config.get("BATCHED_CRITIC", False)
+
+        # Minibatch split into micro-batches with gradients accumulated
+        self.accum_steps = config.get("ACCUM_STEPS", 1)
 
         self.Generator = Generator(
             config=config,
@@ -74,20 +129,42 @@ class GAN(keras.Model):
             config=config,
             constraint_type=cons)
 
-        self.update_mvag_generator(initial=True)
+        # Weights paired by name, updated every EMA_EVERY steps
+        self.EMA = EMA(
+            source=self.Generator,
+            target=self.EMAGenerator,
+            beta=config["EMA_BETA"],
+            every=config.get("EMA_EVERY", 1))
 
-        if config["AUGMENT"]:
-            self.Aug = DiffAug({"colour": True, "translation": True, "cutout": True})
+        if config["AUGMENT"] or config.get("ADA", False):
+            aug_prob = config.get("AUG_PROB", 0.0 if config.get("ADA", False) else 1.0)
+            self.Aug = DiffAug({"colour": True, "translation": True, "cutout": True, "p": aug_prob})
         else:
             self.Aug = None
 
+        if config.get("ADA", False):
+            self.ADA = ADA(
+                p=self.Aug.p,
+                target=config.get("ADA_TARGET", 0.6),
+                every=config.get("ADA_EVERY", 4),
+                speed=config.get("ADA_SPEED", 500000))
+        else:
+            self.ADA = None
+
         self.g_optimiser = g_optimiser
         self.d_optimiser = d_optimiser
         self.n_critic = n_critic
-        self.EMA_beta = config["EMA_BETA"]
-        self.fade_iter = 0
-        self.fade_count = 0
-        self.alpha = 0
+
+        # Fade in state is held in variables so the compiled
+        # training step is not retraced as alpha changes
+        self.fade = False
+        self.fade_iter = tf.Variable(0, dtype=tf.int32, trainable=False)
+        self.fade_count = tf.Variable(0, dtype=tf.int32, trainable=False)
+        self.alpha = tf.Variable(0.0, dtype=tf.float32, trainable=False)
+
+        # Compiled training steps, one per (scale, fade) pair
+        self.train_fns = {}
+        self.trace_count = 0
     
     def compile(self, g_optimiser, d_optimiser, loss_key):
         # Not currently used
@@ -97,118 +174,304 @@ class GAN(keras.Model):
         self.d_optimiser = d_optimiser
         self.loss = self.loss_dict[loss_key]
     
-    def fade_set(self, num_iter):
-        """ Activates or deactivates fade in """
+    def fade_set(self, num_iter, reset=True):
+        """ Activates or deactivates fade in
+            - reset: set to False to keep fade count when resuming """
+
+        self.fade = bool(num_iter)
+        self.fade_iter.assign(num_iter)
+        if reset: self.fade_count.assign(0)
 
-        self.fade_iter = num_iter
-        self.fade_count = 0
+    def build_scale(self, scale):
+        """ Builds network weights needed at scale if not yet built,
+            with new EMAGenerator weights cloned from Generator """
+
+        with self.strategy.scope():
+            self.Generator.build_scale(scale)
+            self.EMAGenerator.build_scale(scale)
+            self.Discriminator.build_scale(scale)
+            self.update_mvag_generator(initial=True)
 
     def set_trainable_layers(self, scale):
-        """ Sets new block to trainable and sets to_rgb/from_rgb
+        """ Sets blocks up to new block to trainable and sets to_rgb/from_rgb
             conv layers in old blocks to untrainable
             to avoid missing gradients """ 
 
-        self.Discriminator.blocks[scale].trainable = True
-        
+        for i in range(0, scale + 1):
+            self.Discriminator.blocks[i].trainable = True
+            self.Generator.blocks[i].trainable = True
+            self.EMAGenerator.blocks[i].trainable = True
+
         for i in range(0, scale):
             self.Discriminator.blocks[i].from_rgb.trainable = False
-        
-        self.Generator.blocks[scale].trainable = True
-        
-        for i in range(0, scale):
             self.Generator.blocks[i].to_rgb.trainable = False
-
-        self.EMAGenerator.blocks[scale].trainable = True
-        
-        for i in range(0, scale):
             self.EMAGenerator.blocks[i].to_rgb.trainable = False
 
     def update_mvag_generator(self, initial=False):
         """ Updates EMAGenerator with Generator weights """
-        # If first use, clone Generator
+        # If first use of weights, clone Generator
         if initial:
-            assert len(self.Generator.weights) == len(self.EMAGenerator.weights)
-            # TODO: potentially dangerous as no variable scopes
-            for idx in range(len(self.EMAGenerator.weights)):
-                self.EMAGenerator.weights[idx].assign(self.Generator.weights[idx])
-            
+            self.EMA.copy()
+        else:
+            self.EMA.update()
+
+    def scale_loss(self, loss, optimiser, batch_mean=True):
+        """ Scales loss if using float16 - call inside gradient tape
+            - batch_mean: loss is a mean over the batch, so divided by number
+              of replicas as gradients are summed across replicas - set False
+              for per-sample losses, whose gradients are already sums """
+
+        if batch_mean:
+            loss = loss / self.strategy.num_replicas_in_sync
+
+        if self.loss_scaling:
+            return optimiser.get_scaled_loss(loss)
         else:
-            for idx in range(len(self.EMAGenerator.trainable_weights)):
-                new_weights = self.EMA_beta * self.EMAGenerator.trainable_weights[idx] + (1 - self.EMA_beta) * self.Generator.trainable_weights[idx]
-                self.EMAGenerator.trainable_weights[idx].assign(new_weights)
+            return loss
+
+    def get_gradients(self, tape, loss, variables, optimiser):
+        """ Gradients of (possibly scaled) loss, unscaled if needed """
+
+        grads = tape.gradient(loss, variables)
+
+        if self.loss_scaling:
+            return optimiser.get_unscaled_gradients(grads)
+        else:
+            return grads
+
+    def gp_loss_scale(self):
+        """ Loss scale for gradient penalty's inner gradients if float16, else None """
+
+        return self.d_optimiser.loss_scale if self.loss_scaling else None
+
+    def batched_critic_step(self, real_images, fake_images, scale):
+        """ Runs fake, real and, if gradient penalty used, interpolated
+            images through critic as one concatenated batch
+            - Returns fake predictions, real predictions, gradient penalty """
+
+        mb_size = real_images.shape[0]
+
+        if not self.grad_penalty:
+            d_pred = self.Discriminator(tf.concat([fake_images, real_images], axis=0), scale, training=True, mb_splits=2)
+
+            return d_pred[0:mb_size], d_pred[mb_size:], None
+
+        epsilon = tf.random.uniform([mb_size, 1, 1, 1], 0.0, 1.0)
+        x_hat = (epsilon * real_images) + ((1 - epsilon) * fake_images)
+
+        loss_scale = self.gp_loss_scale()
+
+        with tf.GradientTape() as tape:
+            tape.watch(x_hat)
+            d_pred = self.Discriminator(tf.concat([fake_images, real_images, x_hat], axis=0), scale, training=True, mb_splits=3)
+            D_hat = d_pred[2 * mb_size:]
+            if loss_scale is not None: D_hat *= tf.cast(loss_scale, D_hat.dtype)
+
+        gradients = tape.gradient(D_hat, x_hat)
+
+        return d_pred[0:mb_size], d_pred[mb_size:2 * mb_size], penalty_from_gradients(gradients, loss_scale)
 
-    # @tf.function
     def train_step(self, real_images, scale):
-        # Determine labels and size of mb for each critic training run
-        # (size of real_images = minibatch size * number of critic runs)
-        mb_size = real_images.shape[0] // self.n_critic
+        """ Runs one training step using a graph compiled for
+            the current scale and fade state - a new graph is traced
+            only the first time each (scale, fade) pair is seen
+            - real_images: batch, or per-replica batches from a
+              distributed dataset """
+
+        key = (scale, self.fade)
+
+        if key not in self.train_fns:
+            fade = self.fade
+
+            # Per-replica batch shapes are fixed by drop_remainder
+            if isinstance(real_images, tf.Tensor):
+                input_signature = [tf.TensorSpec(real_images.shape, real_images.dtype)]
+            else:
+                input_signature = None
+
+            self.train_fns[key] = tf.function(
+                lambda x: self.distributed_train_step(x, scale, fade),
+                input_signature=input_signature)
+
+        return self.train_fns[key](real_images)
+
+    def distributed_train_step(self, real_images, scale, fade):
+        """ Runs training step on each replica, then updates fade in
+            and EMA state once in cross-replica context
+            - Returns dict of wall time (s) per phase, slowest replica
+              for per-replica phases """
+
+        # Python side effect, only runs when tracing
+        self.trace_count += 1
+
+        if fade:
+            self.alpha.assign(tf.cast(self.fade_count, tf.float32) / tf.cast(self.fade_iter, tf.float32))
+            self.Discriminator.alpha = self.alpha
+            self.Generator.alpha = self.alpha
+        else:
+            self.Discriminator.alpha = None
+            self.Generator.alpha = None
+
+        timings = self.strategy.run(self._train_step, args=(real_images, scale))
+        timings = {name: self.strategy.reduce(tf.distribute.ReduceOp.MAX, value, axis=None) for name, value in timings.items()}
+
+        # Stateful ops run in program order, so timestamps bracket each phase
+        ema_start = tf.timestamp()
+        self.update_mvag_generator()
+        timings["ema"] = tf.timestamp() - ema_start
+
+        if self.ADA: self.ADA.update()
+        self.fade_count.assign_add(1)
+
+        return timings
+
+    def critic_gradients(self, real_images, scale):
+        """ Critic gradients for one (micro)batch of real images - per-sample
+            drift term makes loss a vector so gradients are summed over samples,
+            and micro-batch gradients can be summed to give full batch gradients
+            (the same applies to gradient penalty, broadcast over samples)
+            - Returns gradients and ADA statistics for real predictions, which
+              the caller accumulates once outside any micro-batch loop """
+
+        mb_size = real_images.shape[0]
 
         d_labels = tf.concat(
             [tf.ones((mb_size, 1)) * self.d_fake_label,
              tf.ones((mb_size, 1)) * self.d_real_label
              ], axis=0)
-            
-        g_labels = tf.ones((mb_size, 1)) * self.g_label
 
-        if self.fade_iter:
-            self.Discriminator.alpha = self.fade_count / self.fade_iter
-            self.Generator.alpha = self.fade_count / self.fade_iter
-        else:
-            self.Discriminator.alpha = None
-            self.Generator.alpha = None
         # TODO: ADD NOISE TO LABELS AND/OR IMAGES
 
-        # Critic training loop
-        for idx in range(self.n_critic):
-            # Select minibatch of real images and generate fake images
-            d_real_batch = real_images[idx * mb_size:(idx + 1) * mb_size, :, :, :]
-            latent_noise = tf.random.normal((mb_size, self.latent_dims), dtype=tf.float32)
-            d_fake_images = self.Generator(latent_noise, scale, training=True)
+        # Generate fake images
+        latent_noise = tf.random.normal((mb_size, self.latent_dims), dtype=tf.float32)
+        d_fake_images = self.Generator(latent_noise, scale, training=True)
 
-            # DiffAug if required
-            if self.Aug:
-                d_real_batch = self.Aug.augment(d_real_batch)
-                d_fake_images = self.Aug.augment(d_fake_images)
+        # DiffAug if required
+        if self.Aug:
+            real_images = self.Aug.augment(real_images)
+            d_fake_images = self.Aug.augment(d_fake_images)
 
-            # Get gradients from critic predictions and update weights
-            with tf.GradientTape() as d_tape:
+        # Get gradients from critic predictions
+        with tf.GradientTape() as d_tape:
+            if self.batched_critic:
+                d_pred_fake, d_pred_real, grad_penalty = self.batched_critic_step(real_images, d_fake_images, scale)
+            else:
                 d_pred_fake = self.Discriminator(d_fake_images, scale, training=True)
-                d_pred_real = self.Discriminator(d_real_batch, scale, training=True)
-                d_predictions = tf.concat([d_pred_fake, d_pred_real], axis=0)
-                d_loss_1 = self.loss(d_labels[0:mb_size], d_predictions[0:mb_size]) # Fake
-                d_loss_2 = self.loss(d_labels[mb_size:], d_predictions[mb_size:]) # Real
-                d_loss_2 += 0.001 * tf.square(d_predictions[mb_size:]) # Drift term
-                d_loss = d_loss_1 + d_loss_2
-            
-                # Gradient penalty if indicated
-                # TODO: tidy up loss selection
-                if self.GAN_type == "wasserstein-GP" or "progressive":
-                    grad_penalty = gradient_penalty(d_real_batch, d_fake_images, self.Discriminator, scale)
-                    d_loss += 10 * grad_penalty
-            
-            d_grads = d_tape.gradient(d_loss, self.Discriminator.trainable_variables)
-            self.d_optimiser.apply_gradients(zip(d_grads, self.Discriminator.trainable_variables))
+                d_pred_real = self.Discriminator(real_images, scale, training=True)
 
-            # Update metrics
-            self.metric_dict["d_metric_1"].update_state(d_loss_1)
-            self.metric_dict["d_metric_2"].update_state(d_loss_2)
+                if self.grad_penalty:
+                    grad_penalty = gradient_penalty(real_images, d_fake_images, self.Discriminator, scale, self.gp_loss_scale())
 
-        # Generator training
+            d_predictions = tf.concat([d_pred_fake, d_pred_real], axis=0)
+            d_loss_1 = self.loss(d_labels[0:mb_size], d_predictions[0:mb_size]) # Fake
+            d_loss_2 = self.loss(d_labels[mb_size:], d_predictions[mb_size:]) # Real
+            d_loss_2 += 0.001 * tf.square(d_predictions[mb_size:]) # Drift term
+            d_loss = d_loss_1 + d_loss_2
+        
+            # Gradient penalty if indicated
+            # TODO: tidy up loss selection
+            if self.grad_penalty:
+                d_loss += 10 * grad_penalty
+
+            # Gradient is a sum over samples, so summing across replicas matches single device
+            d_loss = self.scale_loss(d_loss, self.d_optimiser, batch_mean=False)
+        
+        # Track critic overfitting for adaptive augmentation
+        ada_stats = ADA.sign_stats(self.realness(d_pred_real)) if self.ADA else tf.zeros([2])
+
+        # Update metrics
+        self.metric_dict["d_metric_1"].update_state(d_loss_1)
+        self.metric_dict["d_metric_2"].update_state(d_loss_2)
+
+        return self.get_gradients(d_tape, d_loss, self.Discriminator.trainable_variables, self.d_optimiser), ada_stats
+
+    def generator_gradients(self, mb_size, scale, weight=1.0):
+        """ Generator gradients for one (micro)batch of generated images
+            - weight: loss is a batch mean, so weighted by 1 / number of
+              micro-batches if gradients are accumulated """
+
+        g_labels = tf.ones((mb_size, 1)) * self.g_label
         noise = tf.random.normal((mb_size, self.latent_dims), dtype=tf.float32)
         
         # TODO: ADD NOISE TO LABELS AND/OR IMAGES
 
-        # Get gradients from critic predictions of generated fake images and update weights
+        # Get gradients from critic predictions of generated fake images
         with tf.GradientTape() as g_tape:
             g_fake_images = self.Generator(noise, scale, training=True)
             if self.Aug: g_fake_images = self.Aug.augment(g_fake_images)
             g_predictions = self.Discriminator(g_fake_images, scale, training=True)
             g_loss = self.loss(g_labels, g_predictions)
-        
-        g_grads = g_tape.gradient(g_loss, self.Generator.trainable_variables)
-        self.g_optimiser.apply_gradients(zip(g_grads, self.Generator.trainable_variables))
-        self.update_mvag_generator()
+            g_scaled_loss = self.scale_loss(g_loss * weight, self.g_optimiser)
 
-        # Update metric and increment fade count
+        # Update metric
         self.metric_dict["g_metric"].update_state(g_loss)
-        self.fade_count += 1
+
+        return self.get_gradients(g_tape, g_scaled_loss, self.Generator.trainable_variables, self.g_optimiser)
+
+    def accumulate_gradients(self, grad_fn, variables, aux=None):
+        """ Sums gradients from grad_fn(step) over ACCUM_STEPS micro-batches
+            in a graph loop, so activations of one micro-batch are held at a time
+            - aux: if given, grad_fn returns (gradients, aux tensor), and aux
+              summed over micro-batches is returned with the gradients """
+
+        grads = [tf.zeros_like(v) for v in variables]
+
+        for step in tf.range(self.accum_steps):
+            # Micro-batches only depend on loop counter, so would otherwise run concurrently
+            tf.autograph.experimental.set_loop_options(parallel_iterations=1)
+
+            if aux is None:
+                step_grads = grad_fn(step)
+            else:
+                step_grads, step_aux = grad_fn(step)
+                aux += step_aux
+
+            grads = [g if s is None else g + s for g, s in zip(grads, step_grads)]
+
+        if aux is None:
+            return grads
+        else:
+            return grads, aux
+
+    def _train_step(self, real_images, scale):
+        critic_start = tf.timestamp()
+
+        # Determine size of mb for each critic training run
+        # (size of real_images = per-replica minibatch size * number of critic runs)
+        mb_size = real_images.shape[0] // self.n_critic
+        micro_size = mb_size // self.accum_steps
+        assert mb_size % self.accum_steps == 0, "Minibatch size must be divisible by ACCUM_STEPS"
+        assert self.accum_steps == 1 or micro_size % 4 == 0, \
+            f"Micro-batch size (minibatch / ACCUM_STEPS = {micro_size}) must be a multiple of minibatch stddev group size 4"
+
+        # Critic training loop
+        for idx in range(self.n_critic):
+            # Select minibatch of real images
+            d_real_batch = real_images[idx * mb_size:(idx + 1) * mb_size, :, :, :]
+
+            if self.accum_steps == 1:
+                d_grads, ada_stats = self.critic_gradients(d_real_batch, scale)
+            else:
+                # Minibatch stddev groups are strided {m, m + M, m + 2M, m + 3M}, so each micro-batch
+                # takes the same stride from all 4 quarters of the minibatch to keep full batch groups
+                img_dims = d_real_batch.shape[1:].as_list()
+                micro_batches = tf.reshape(d_real_batch, [4, self.accum_steps, micro_size // 4] + img_dims)
+                micro_batches = tf.transpose(micro_batches, [1, 0, 2, 3, 4, 5])
+                micro_batches = tf.reshape(micro_batches, [self.accum_steps, micro_size] + img_dims)
+                d_grads, ada_stats = self.accumulate_gradients(
+                    lambda step: self.critic_gradients(micro_batches[step], scale), self.Discriminator.trainable_variables, aux=tf.zeros([2]))
+
+            if self.ADA: self.ADA.accumulate(ada_stats)
+            self.d_optimiser.apply_gradients(zip(d_grads, self.Discriminator.trainable_variables))
+
+        # Generator training
+        generator_start = tf.timestamp()
+
+        if self.accum_steps == 1:
+            g_grads = self.generator_gradients(mb_size, scale)
+        else:
+            g_grads = self.accumulate_gradients(lambda _: self.generator_gradients(micro_size, scale, weight=1 / self.accum_steps), self.Generator.trainable_variables)
+
+        self.g_optimiser.apply_gradients(zip(g_grads, self.Generator.trainable_variables))
+
+        return {"critic": generator_start - critic_start, "generator": tf.timestamp() - generator_start}
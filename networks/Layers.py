@@ -15,19 +15,34 @@ class EqDense(keras.layers.Dense):
         for equalised learning rate, taken from
         https://github.com/tensorflow/tensorflow/blob/v2.3.1/tensorflow/python/keras/layers/core.py """
     
-    def __init__(self, **kwargs):
-        """ Initialise Dense with the usual arguments """
+    def __init__(self, gain=np.sqrt(2.0), **kwargs):
+        """ Initialise Dense with the usual arguments plus He gain """
         super(EqDense, self).__init__(**kwargs)
 
+        self.gain = gain
         self.weight_scale = None
+        self.scale_inputs = None
+
+    def build(self, input_shape):
+        """ Weight scale fixed once kernel shape is known """
+        super(EqDense, self).build(input_shape)
+
+        fan_in = np.prod(self.kernel.shape[:-1])
+        self.weight_scale = float(self.gain / np.sqrt(fan_in))
+
+        # Scale whichever of input or output is smaller instead of kernel
+        self.scale_inputs = self.kernel.shape[0] <= self.units
     
-    def call(self, inputs, gain=tf.sqrt(2.0)):
-        if self.weight_scale is None:
-            fan_in = tf.reduce_prod(self.kernel.shape[:-1])
-            self.weight_scale = gain / tf.sqrt(tf.cast(fan_in, tf.float32))
+    def call(self, inputs):
+        if self.scale_inputs:
+            inputs = inputs * self.weight_scale
 
         # Perform matmul
-        outputs = gen_math_ops.MatMul(a=inputs, b=self.kernel * self.weight_scale)
+        outputs = gen_math_ops.MatMul(a=inputs, b=self.kernel)
+
+        if not self.scale_inputs:
+            outputs = outputs * self.weight_scale
+
         outputs = nn_ops.bias_add(outputs, self.bias)
         
         # Activation not needed
@@ -39,20 +54,36 @@ class EqLrConv2D(keras.layers.Conv2D):
         for equalised learning rate, taken from
         https://github.com/tensorflow/tensorflow/blob/master/tensorflow/python/keras/layers/convolutional.py """
 
-    def __init__(self, **kwargs):
-        """ Initialise Conv2D with the usual arguments """
+    def __init__(self, gain=np.sqrt(2.0), **kwargs):
+        """ Initialise Conv2D with the usual arguments plus He gain """
         super(EqLrConv2D, self).__init__(**kwargs)
         
+        self.gain = gain
         self.weight_scale = None
+        self.scale_inputs = None
+
+    def build(self, input_shape):
+        """ Weight scale fixed once kernel shape is known """
+        super(EqLrConv2D, self).build(input_shape)
+
+        fan_in = np.prod(self.kernel.shape[:-1])
+        self.weight_scale = float(self.gain / np.sqrt(fan_in))
+
+        # Scale whichever of input or output has fewer elements
+        in_channels = self.kernel.shape[-2]
+        self.scale_inputs = in_channels <= self.filters / np.prod(self.strides)
     
-    def call(self, inputs, gain=tf.sqrt(2.0)):
+    def call(self, inputs):
         """ Overloaded call to apply weight scale at runtime """
-        if self.weight_scale is None:
-            fan_in = tf.reduce_prod(self.kernel.shape[:-1])
-            self.weight_scale = gain / tf.sqrt(tf.cast(fan_in, tf.float32))
+        if self.scale_inputs:
+            inputs = inputs * self.weight_scale
 
         # Perform convolution and add bias weights
-        outputs = self._convolution_op(inputs, self.kernel * self.weight_scale)
+        outputs = self._convolution_op(inputs, self.kernel)
+
+        if not self.scale_inputs:
+            outputs = outputs * self.weight_scale
+
         outputs = tf.nn.bias_add(outputs, self.bias, data_format="NHWC")
 
         # Activation not needed
@@ -66,18 +97,29 @@ class EqLrConv2DTranspose(keras.layers.Conv2DTranspose):
         for (1, 1, 1) -> (4, 4, N) transpose conv - taken from
         https://github.com/tensorflow/tensorflow/blob/master/tensorflow/python/keras/layers/convolutional.py"""
 
-    def __init__(self, **kwargs):
-        """ Initialise Conv2DTranspose with the usual arguments """
+    def __init__(self, gain=np.sqrt(2.0), **kwargs):
+        """ Initialise Conv2DTranspose with the usual arguments plus He gain """
 
         super(EqLrConv2DTranspose, self).__init__(**kwargs)
         
+        self.gain = gain
         self.weight_scale = None
+        self.scale_inputs = None
+
+    def build(self, input_shape):
+        """ Weight scale fixed once kernel shape is known """
+        super(EqLrConv2DTranspose, self).build(input_shape)
+
+        fan_in = np.prod(self.kernel.shape[:-1])
+        self.weight_scale = float(self.gain / np.sqrt(fan_in))
 
-    def call(self, inputs, gain=tf.sqrt(2.0)):
+        # 4x4xN output only
+        self.scale_inputs = np.prod(input_shape[1:]) <= 16 * self.filters
+
+    def call(self, inputs):
         """ Overloaded call to apply weight scale at runtime """
-        if not self.weight_scale:
-            fan_in = tf.reduce_prod(self.kernel.shape[:-1])
-            self.weight_scale = gain / tf.sqrt(tf.cast(fan_in, tf.float32))
+        if self.scale_inputs:
+            inputs = inputs * self.weight_scale
         
         # 4x4xN output only
         inputs_shape = inputs.shape
@@ -88,7 +130,7 @@ class EqLrConv2DTranspose(keras.layers.Conv2DTranspose):
         
         outputs = keras.backend.conv2d_transpose(
             inputs,
-            self.kernel * self.weight_scale,
+            self.kernel,
             output_shape_tensor,
             strides=self.strides,
             padding=self.padding,
@@ -99,6 +141,9 @@ class EqLrConv2DTranspose(keras.layers.Conv2DTranspose):
             out_shape = self.compute_output_shape(inputs.shape)
             outputs.set_shape(out_shape)
 
+        if not self.scale_inputs:
+            outputs = outputs * self.weight_scale
+
         if self.use_bias:
             outputs = tf.nn.bias_add(outputs,self.bias, data_format="NHWC")
 
@@ -107,24 +152,36 @@ class EqLrConv2DTranspose(keras.layers.Conv2DTranspose):
 
 
 def fade_in(alpha, old, new):
+    alpha = tf.cast(alpha, new.dtype)
     return (1.0 - alpha) * old + alpha * new
     
 
-def mb_stddev(x, group_size=4):
+def mb_stddev(x, group_size=4, num_splits=1):
+    """ Minibatch stddev - x can consist of num_splits concatenated
+        minibatches, in which case groups are formed within each
+        - statistics computed in float32 under mixed precision
+        - groups are taken by stride i.e. {m, m + M, m + 2M, ...} for M = batch / group_size
+        - if distributed, groups are formed within each replica's batch, so differ from
+          single device groups, although both are random groups of samples - per-replica
+          batch must then be a multiple of group_size (checked in Training.py) """
+
     dims = x.shape
-    group_size = tf.reduce_min([group_size, dims[0]])
-    y = tf.reshape(x, [group_size, -1, dims[1], dims[2], dims[3]])
-    y = tf.reduce_mean(tf.math.reduce_std(y, axis=0), axis=[1, 2, 3], keepdims=True)
-    y = tf.tile(y, [group_size, dims[1], dims[2], 1])
+    group_size = tf.reduce_min([group_size, dims[0] // num_splits])
+    y = tf.reshape(tf.cast(x, tf.float32), [num_splits, group_size, -1, dims[1], dims[2], dims[3]])
+    y = tf.reduce_mean(tf.math.reduce_std(y, axis=1), axis=[2, 3, 4], keepdims=True)
+    y = tf.tile(y, [1, group_size, dims[1], dims[2], 1])
+    y = tf.reshape(y, [dims[0], dims[1], dims[2], 1])
     
-    return tf.concat([x, y], axis=-1)
+    return tf.concat([x, tf.cast(y, x.dtype)], axis=-1)
   
 
 def pixel_norm(x):
-    x_sq = tf.reduce_mean(tf.square(x), axis=-1, keepdims=True)
+    # Computed in float32 under mixed precision
+    x_32 = tf.cast(x, tf.float32)
+    x_sq = tf.reduce_mean(tf.square(x_32), axis=-1, keepdims=True)
     x_norm = tf.sqrt(x_sq + 1e-8)
     
-    return x / x_norm
+    return tf.cast(x_32 / x_norm, x.dtype)
 
 
 class GANBlock(keras.layers.Layer):
@@ -150,7 +207,12 @@ class GANBlock(keras.layers.Layer):
 
 
 class ProgGANDiscBlock(keras.layers.Layer):
-    def __init__(self, ch, next_block, res, GAN_type, weight_const):
+
+    """ Single discriminator block - from_rgb is applied by
+        Discriminator only for the active and fading blocks
+        - last_block: whether block collapses to prediction """
+
+    def __init__(self, ch, last_block, res, GAN_type, weight_const):
         super(ProgGANDiscBlock, self).__init__()
         double_ch = np.min([ch * 2, res])
 
@@ -158,20 +220,22 @@ class ProgGANDiscBlock(keras.layers.Layer):
             Dense = EqDense
             Conv2D = EqLrConv2D
             initialiser = keras.initializers.RandomNormal(0, 1)
+            out_gain = {"gain": 1.0} # Gain as in original implementation
         else:
             Dense = keras.layers.Dense
             Conv2D = keras.layers.Conv2D 
             initialiser = keras.initializers.RandomNormal(0, 0.02)
+            out_gain = {}
 
-        self.next_block = next_block
+        self.last_block = last_block
         self.from_rgb = Conv2D(filters=ch, kernel_size=(1, 1), strides=(1, 1), padding="SAME", kernel_initializer=initialiser, kernel_constraint=weight_const)
         
         # If this is last discriminator block, collapse to prediction
-        if next_block == None:
+        if last_block:
             self.conv = Conv2D(filters=double_ch, kernel_size=(3, 3), strides=(1, 1), padding="SAME", kernel_initializer=initialiser, kernel_constraint=weight_const)
             self.flat = keras.layers.Flatten()
             self.dense = Dense(units=res, kernel_initializer=initialiser, kernel_constraint=weight_const)
-            self.out = Dense(units=1, kernel_initializer=initialiser, kernel_constraint=weight_const)
+            self.out = Dense(units=1, kernel_initializer=initialiser, kernel_constraint=weight_const, **out_gain)
         
         # If next blocks exist, conv and downsample
         else:
@@ -179,64 +243,56 @@ class ProgGANDiscBlock(keras.layers.Layer):
             self.conv2 = Conv2D(filters=double_ch, kernel_size=(3, 3), strides=(1, 1), padding="SAME", kernel_initializer=initialiser, kernel_constraint=weight_const)
             self.downsample = keras.layers.AveragePooling2D()
 
-    def call(self, x, alpha=None, first_block=True):
-        
-        # If fade in, pass downsampled image into next block and cache
-        if first_block and alpha != None and self.next_block != None:
-            next_rgb = self.downsample(x)
-            next_rgb = tf.nn.leaky_relu(self.next_block.from_rgb(next_rgb), alpha=0.2)
+    def call(self, x, mb_splits=1):
 
-        # If the very first block, perform 1x1 conv on rgb
-        if first_block:
-            x = tf.nn.leaky_relu(self.from_rgb(x), alpha=0.2)
-
-        # If this is not the last block
-        if self.next_block != None:
+        # If this is not the last block, conv and downsample
+        if not self.last_block:
             x = tf.nn.leaky_relu(self.conv1(x), alpha=0.2)
             x = tf.nn.leaky_relu(self.conv2(x), alpha=0.2)
             x = self.downsample(x)
-
-            # If fade in, merge with cached layer
-            if first_block and alpha != None and self.next_block != None:
-                x = fade_in(alpha, next_rgb, x)
-            
-            x = self.next_block(x, alpha=None, first_block=False)
         
         # If this is the last block
         else:
-            x = mb_stddev(x)
+            x = mb_stddev(x, num_splits=mb_splits)
             x = tf.nn.leaky_relu(self.conv(x), alpha=0.2)
             x = self.flat(x)
             x = tf.nn.leaky_relu(self.dense(x))
-            x = self.out(x, gain=1) # Gain as in original implementation
+            x = self.out(x)
 
         return x
 
 
 class ProgGANGenBlock(keras.layers.Layer):
-    def __init__(self, latent_dims, ch, prev_block, GAN_type, weight_const):
+
+    """ Single generator block - to_rgb is applied by
+        Generator only for the active and fading blocks
+        - first_block: whether block takes latent noise as input """
+
+    def __init__(self, latent_dims, ch, first_block, GAN_type, weight_const):
         super(ProgGANGenBlock, self).__init__()
 
-        self.prev_block = prev_block
+        self.first_block = first_block
 
         if GAN_type == "progressive":
             Dense = EqDense
             Conv2D = EqLrConv2D
             Conv2DTranspose = EqLrConv2DTranspose
             initialiser = keras.initializers.RandomNormal(0, 1)
+            dense_gain = {"gain": np.sqrt(2.0) / 4} # As in original implementation
         else:
             Dense = keras.layers.Dense
             Conv2D = keras.layers.Conv2D
             Conv2DTranspose = keras.layers.Conv2DTranspose
             initialiser = keras.initializers.RandomNormal(0, 0.02)
+            dense_gain = {}
         
         # If this is first generator block, pass latent noise into dense and reshape
-        if prev_block == None:
-            self.dense = Dense(units=latent_dims * 16, kernel_initializer=initialiser, kernel_constraint=weight_const)
+        if first_block:
+            self.dense = Dense(units=latent_dims * 16, kernel_initializer=initialiser, kernel_constraint=weight_const, **dense_gain)
             self.reshaped = keras.layers.Reshape((4, 4, latent_dims))
             self.conv = Conv2D(filters=ch, kernel_size=(3, 3), strides=(1, 1), padding="SAME", kernel_initializer=initialiser, kernel_constraint=weight_const)
         
-        # If previous blocks exist, we use those
+        # If previous blocks exist, upsample their output
         else:
             self.upsample = keras.layers.UpSampling2D(interpolation="bilinear")
             self.conv1 = Conv2D(filters=ch, kernel_size=(3, 3), strides=(1, 1), padding="SAME", kernel_initializer=initialiser, kernel_constraint=weight_const)
@@ -245,28 +301,19 @@ class ProgGANGenBlock(keras.layers.Layer):
         # Output to rgb
         self.to_rgb = Conv2D(filters=3, kernel_size=(1, 1), strides=(1, 1), padding="SAME", kernel_initializer=initialiser, kernel_constraint=weight_const)
 
-    def call(self, x, alpha=None):
+    def call(self, x):
 
         # If first block, upsample noise
-        if self.prev_block == None:
+        if self.first_block:
             x = pixel_norm(x)
-            x = pixel_norm(tf.nn.leaky_relu(self.dense(x, gain=tf.sqrt(2.0) / 4), alpha=0.2)) # As in original implementation
+            x = pixel_norm(tf.nn.leaky_relu(self.dense(x), alpha=0.2))
             x = self.reshaped(x)
             x = pixel_norm(tf.nn.leaky_relu(self.conv(x), alpha=0.2))
         
-        # If not first block, upsample to_rgb and cache for fade in
+        # If not first block, upsample previous block's features
         else:
-            prev_x, prev_rgb = self.prev_block(x, alpha=None)
-            prev_x = self.upsample(prev_x)
-            x = pixel_norm(tf.nn.leaky_relu(self.conv1(prev_x), alpha=0.2))
+            x = self.upsample(x)
+            x = pixel_norm(tf.nn.leaky_relu(self.conv1(x), alpha=0.2))
             x = pixel_norm(tf.nn.leaky_relu(self.conv2(x), alpha=0.2))
 
-        # Create output image
-        rgb = self.to_rgb(x)
-
-        # If fade in, merge cached prev block and this block
-        if alpha != None and self.prev_block != None:
-            prev_rgb = self.upsample(prev_rgb)
-            rgb = fade_in(alpha, prev_rgb, rgb)
-        
-        return x, rgb
+        return x
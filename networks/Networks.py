@@ -2,7 +2,7 @@ import numpy as np
 import tensorflow as tf
 import tensorflow.keras as keras
 
-from networks.Layers import ProgGANGenBlock, ProgGANDiscBlock
+from networks.Layers import ProgGANGenBlock, ProgGANDiscBlock, fade_in
 from utils.TrainFuncs import WeightClipConstraint
 
 
@@ -29,6 +29,38 @@ class BaseGAN(keras.Model):
     def call(self):
         raise NotImplementedError
 
+    def get_input_spec(self, scale):
+        raise NotImplementedError
+
+    def get_output_shape(self, scale):
+        raise NotImplementedError
+
+    def trace_scale(self, scale, alpha):
+        """ Traces forward pass at scale symbolically, building any
+            missing weights without running computation
+            - Returns output shape """
+
+        prev_alpha = self.alpha
+        self.alpha = alpha
+        concrete_fn = tf.function(lambda x: self(x, scale, training=False)).get_concrete_function(self.get_input_spec(scale))
+        self.alpha = prev_alpha
+
+        return concrete_fn.structured_outputs.shape
+
+    def build_scale(self, scale):
+        """ Builds weights needed at scale, including for fade in """
+
+        self.trace_scale(scale, alpha=0.5)
+
+    def self_test(self):
+        """ Validates output shapes at all scales, with and without fade in
+            - builds all weights, so only run if SELF_TEST set in config """
+
+        for scale in range(self.num_layers):
+            for alpha in [None, 0.5]:
+                shape = self.trace_scale(scale, alpha)
+                assert shape == self.get_output_shape(scale), (scale, alpha, shape)
+
 
 class Discriminator(BaseGAN):
 
@@ -47,26 +79,46 @@ class Discriminator(BaseGAN):
         self.channels = [np.min([(config["NDF"] * 2 ** i), config["MAX_CHANNELS"]]) for i in range(self.num_layers) ]
         self.channels.reverse()
         
-        self.blocks.append(ProgGANDiscBlock(self.channels[0], None, config["MAX_CHANNELS"], config["MODEL"], self.weight_const))
+        self.blocks.append(ProgGANDiscBlock(self.channels[0], True, config["MAX_CHANNELS"], config["MODEL"], self.weight_const))
 
         for i in range(1, self.num_layers):
-            new_block = ProgGANDiscBlock(self.channels[i], self.blocks[i - 1], config["MAX_CHANNELS"], config["MODEL"], self.weight_const)
+            new_block = ProgGANDiscBlock(self.channels[i], False, config["MAX_CHANNELS"], config["MODEL"], self.weight_const)
             new_block.trainable = False
             self.blocks.append(new_block)
 
-        # Recursive self test on start up
-        for i in range(self.num_layers):
-            test = tf.zeros((2, 4 * (2 ** i), 4 * (2 ** i), 3), dtype=tf.float32)
-            assert self.blocks[i](test, alpha=None).shape == (2, 1), self.blocks[i](test).shape
-        
-        for i in range(self.num_layers):
-            test = tf.zeros((2, 4 * (2 ** i), 4 * (2 ** i), 3), dtype=tf.float32)
-            assert self.blocks[i](test, alpha=0.5).shape == (2, 1), self.blocks[i](test, alpha=0.5).shape
+        # Weights are built lazily as scales are reached
+        if config.get("SELF_TEST", False): self.self_test()
 
-    def call(self, x, scale, training=True):
-        x = self.blocks[scale](x, self.alpha)
+    def get_input_spec(self, scale):
+        return tf.TensorSpec((2, 4 * (2 ** scale), 4 * (2 ** scale), 3), dtype=tf.float32)
+
+    def get_output_shape(self, scale):
+        return (2,)
+
+    def call(self, x, scale, training=True, mb_splits=1):
+        """ mb_splits: number of concatenated minibatches in x,
+            to keep minibatch stddev groups within each """
+
+        fade = self.alpha is not None and scale > 0
+
+        # If fade in, pass downsampled image into next block's from_rgb and cache
+        if fade:
+            next_rgb = self.blocks[scale].downsample(x)
+            next_rgb = tf.nn.leaky_relu(self.blocks[scale - 1].from_rgb(next_rgb), alpha=0.2)
+
+        # Only the active block converts from rgb
+        x = tf.nn.leaky_relu(self.blocks[scale].from_rgb(x), alpha=0.2)
+        x = self.blocks[scale](x, mb_splits=mb_splits)
+
+        # If fade in, merge with cached layer
+        if fade:
+            x = fade_in(self.alpha, next_rgb, x)
+
+        for block in reversed(self.blocks[0:scale]):
+            x = block(x, mb_splits=mb_splits)
         
-        return tf.squeeze(x)
+        # Predictions in float32 for loss under mixed precision
+        return tf.cast(tf.squeeze(x), tf.float32)
 
 
 class Generator(BaseGAN):
@@ -80,27 +132,41 @@ class Generator(BaseGAN):
         super(Generator, self).__init__(config, constraint_type)
 
         latent_dims = config["LATENT_DIM"]
+        self.latent_dims = latent_dims
         self.channels = [np.min([(config["NGF"] * 2 ** i), config["MAX_CHANNELS"]]) for i in range(self.num_layers) ]
         self.channels.reverse()
 
-        self.blocks.append(ProgGANGenBlock(latent_dims, self.channels[0], None, config["MODEL"], self.weight_const))
+        self.blocks.append(ProgGANGenBlock(latent_dims, self.channels[0], True, config["MODEL"], self.weight_const))
 
         for i in range(1, self.num_layers):
-            new_block = ProgGANGenBlock(latent_dims, self.channels[i], self.blocks[i - 1], config["MODEL"], self.weight_const)
+            new_block = ProgGANGenBlock(latent_dims, self.channels[i], False, config["MODEL"], self.weight_const)
             new_block.trainable = False
             self.blocks.append(new_block)
 
-        # Recursive self test on start up
-        for i in range(0, self.num_layers):
-            test = tf.zeros((2, latent_dims), dtype=tf.float32)
-            assert self.blocks[i](test, alpha=None)[1].shape == (2, 4 * (2 ** i), 4 * (2 ** i), 3), self.blocks[i](test, alpha=None).shape
+        # Weights are built lazily as scales are reached
+        if config.get("SELF_TEST", False): self.self_test()
+
+    def get_input_spec(self, scale):
+        return tf.TensorSpec((2, self.latent_dims), dtype=tf.float32)
 
-        for i in range(0, self.num_layers):
-            test = tf.zeros((2, latent_dims), dtype=tf.float32)
-            assert self.blocks[i](test, alpha=0.5)[1].shape == (2, 4 * (2 ** i), 4 * (2 ** i), 3), self.blocks[i](test, alpha=0.5).shape
+    def get_output_shape(self, scale):
+        return (2, 4 * (2 ** scale), 4 * (2 ** scale), 3)
 
     def call(self, x, scale, training=True):
-        _, rgb = self.blocks[scale](x, self.alpha)
+        for block in self.blocks[0:scale]:
+            x = block(x)
+
+        # Cache previous block's features for fade in
+        prev_x = x
+        x = self.blocks[scale](x)
+
+        # Only the active (and fading) blocks convert to rgb
+        rgb = self.blocks[scale].to_rgb(x)
+
+        if self.alpha is not None and scale > 0:
+            prev_rgb = self.blocks[scale].upsample(self.blocks[scale - 1].to_rgb(prev_x))
+            rgb = fade_in(self.alpha, prev_rgb, rgb)
 
-        return tf.nn.tanh(rgb)
+        # Output in float32 under mixed precision
+        return tf.nn.tanh(tf.cast(rgb, tf.float32))
 
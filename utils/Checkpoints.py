@@ -0,0 +1,174 @@
+import os
+import queue
+import threading
+import tensorflow as tf
+
+from utils.TrainFuncs import get_weight_dict
+
+
+def get_state_dict(Model):
+    """ Returns dict of all variables needed to resume training, keyed
+        by network and weight structure e.g. 'generator/2/conv1/kernel'
+        - optimiser slots are keyed by the weight they belong to
+        - Model: GAN being trained """
+
+    state = {
+        "fade_count": Model.fade_count,
+        "fade_iter": Model.fade_iter,
+        "ema_step": Model.EMA.step,
+        "g_optimiser/iterations": Model.g_optimiser.iterations,
+        "d_optimiser/iterations": Model.d_optimiser.iterations
+    }
+
+    # Augmentation probability changes during training if adaptive
+    if Model.Aug:
+        state["aug_p"] = Model.Aug.p
+
+    if Model.ADA:
+        state["ada_step"] = Model.ADA.step
+        state["ada_sign_sum"] = Model.ADA.sign_sum
+        state["ada_count"] = Model.ADA.count
+
+    # Dynamic loss scale and good step count, so resuming doesn't restart from initial
+    # scale and skip steps while it settles (Keras OptimizerV2 LossScaleOptimizer, TF 2.4-2.10)
+    if Model.loss_scaling:
+        for opt_name, optimiser in [("g_optimiser", Model.g_optimiser), ("d_optimiser", Model.d_optimiser)]:
+            state[f"{opt_name}/loss_scale"] = optimiser._loss_scale.current_loss_scale
+            state[f"{opt_name}/good_steps"] = optimiser.dynamic_counter
+
+    networks = {
+        "generator": (Model.Generator, Model.g_optimiser),
+        "ema_generator": (Model.EMAGenerator, None),
+        "discriminator": (Model.Discriminator, Model.d_optimiser)
+    }
+
+    for net_name, (net, optimiser) in networks.items():
+        # Slots are held by inner optimiser if loss scaling used
+        optimiser = getattr(optimiser, "inner_optimizer", optimiser)
+
+        for key, weight in get_weight_dict(net).items():
+            state[f"{net_name}/{key}"] = weight
+
+            if optimiser is None: continue
+
+            # Slots only exist for weights that have been trained
+            for slot_name in optimiser.get_slot_names():
+                try:
+                    state[f"{net_name}_optimiser/{key}/{slot_name}"] = optimiser.get_slot(weight, slot_name)
+                except KeyError:
+                    pass
+
+    return state
+
+
+def read_checkpoint_meta(path):
+    """ Reads position in training from checkpoint without restoring networks
+        - Returns dict with scale index, fade and number of completed epochs """
+
+    meta = tf.Module()
+    meta.state = {
+        "meta/idx": tf.Variable(0),
+        "meta/scale_idx": tf.Variable(0),
+        "meta/fade": tf.Variable(0),
+        "meta/epoch": tf.Variable(0)
+    }
+
+    tf.train.Checkpoint(state=meta).restore(path).expect_partial()
+
+    return {
+        "idx": int(meta.state["meta/idx"].numpy()),
+        "scale_idx": int(meta.state["meta/scale_idx"].numpy()),
+        "fade": bool(meta.state["meta/fade"].numpy()),
+        "epoch": int(meta.state["meta/epoch"].numpy())
+    }
+
+
+class Checkpointer:
+
+    """ Saves and restores training state using tf.train.CheckpointManager
+        - Model: GAN being trained
+        - save_path: checkpoint directory
+        - max_to_keep: number of checkpoints retained
+
+        State is copied into CPU shadow variables on the calling thread
+        and written to disk by a background thread, so training is not
+        blocked by file writes """
+
+    def __init__(self, Model, save_path, max_to_keep=3):
+        self.Model = Model
+        if not os.path.exists(save_path): os.makedirs(save_path)
+
+        self.shadow = tf.Module()
+        self.shadow.state = {}
+        self.manager = tf.train.CheckpointManager(
+            tf.train.Checkpoint(state=self.shadow), save_path, max_to_keep=max_to_keep)
+
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def write(self):
+        while True:
+            item = self.queue.get()
+
+            if item is None:
+                self.queue.task_done()
+                break
+
+            self.manager.save()
+            self.queue.task_done()
+
+    def save(self, idx, scale_idx, fade, epoch):
+        """ Snapshots state and queues checkpoint write
+            - idx: index of current scale in SCALES
+            - scale_idx: index of current network block
+            - fade: whether in fade in phase
+            - epoch: number of epochs completed in this phase """
+
+        # Shadow variables must not change while previous write in progress
+        self.queue.join()
+
+        state = get_state_dict(self.Model)
+        state["meta/idx"] = idx
+        state["meta/scale_idx"] = scale_idx
+        state["meta/fade"] = int(fade)
+        state["meta/epoch"] = epoch
+
+        with tf.device("CPU:0"):
+            for key, value in state.items():
+                if key in self.shadow.state:
+                    self.shadow.state[key].assign(value)
+                else:
+                    self.shadow.state[key] = tf.Variable(value, trainable=False)
+
+        self.queue.put(epoch)
+
+    def restore(self, path=None):
+        """ Restores latest (or given) checkpoint into Model
+            - Returns checkpoint meta dict, or None if no checkpoint found """
+
+        path = path or self.manager.latest_checkpoint
+        if path is None: return None
+
+        # Weights are built lazily so must be built up to checkpointed scale
+        meta = read_checkpoint_meta(path)
+        self.Model.build_scale(meta["scale_idx"])
+
+        # Optimiser slots must exist before they can be restored - _create_all_weights
+        # is private to Keras OptimizerV2 (TF 2.4-2.10, tf.keras.optimizers.legacy after)
+        with self.Model.strategy.scope():
+            for optimiser, net in [(self.Model.g_optimiser, self.Model.Generator), (self.Model.d_optimiser, self.Model.Discriminator)]:
+                optimiser = getattr(optimiser, "inner_optimizer", optimiser)
+                optimiser._create_all_weights(list(get_weight_dict(net).values()))
+
+        live = tf.Module()
+        live.state = get_state_dict(self.Model)
+        tf.train.Checkpoint(state=live).restore(path).expect_partial()
+
+        return meta
+
+    def close(self):
+        """ Waits for pending write and stops writer thread """
+
+        self.queue.put(None)
+        self.thread.join()
@@ -1,111 +1,609 @@
+import glob
+import hashlib
+import json
 import matplotlib.pyplot as plt
 import numpy as np
 import os
 import tensorflow as tf
 
 
+def normalise_batch(imgs, bounds=None):
+    """ Scales batch of images (B, H, W, C) to [-1, 1]
+        - bounds: precomputed (min, max), either scalars or per-sample
+          tensors of shape (B, 1, 1, 1) - values outside are clipped
+          (if None, min/max of each sample are used) """
+
+    if bounds is None:
+        img_min = tf.reduce_min(imgs, axis=[1, 2, 3], keepdims=True)
+        img_max = tf.reduce_max(imgs, axis=[1, 2, 3], keepdims=True)
+    else:
+        img_min, img_max = bounds
+        imgs = tf.clip_by_value(imgs, img_min, img_max)
+
+    return (imgs - img_min) / (img_max - img_min) * 2 - 1
+
+
+def random_flip(imgs):
+    """ Flips each image in batch horizontally with probability 0.5 - done as
+        a parallel map in the pipeline so it overlaps with training, and
+        before batches are split across replicas """
+
+    flip = tf.random.uniform([tf.shape(imgs)[0], 1, 1, 1]) > 0.5
+
+    return tf.where(flip, tf.reverse(imgs, axis=[2]), imgs)
+
+
+class PyramidCache:
+
+    """ On-disk cache of dataset images at each resolution, stored as
+        uint8 .npy arrays of shape (N, res, res, 3) and memory mapped on read
+        - cache_path: directory to hold cache
+        - file_path: source image directory
+        - dataset_size: number of images used (0 or None for all)
+        - resolutions: list of resolutions to cache """
+
+    def __init__(self, cache_path, file_path, dataset_size, resolutions):
+        self.cache_path = cache_path
+        self.file_path = file_path
+        self.dataset_size = dataset_size
+        self.resolutions = list(resolutions)
+        self.levels = {}
+
+        if not os.path.exists(self.cache_path): os.makedirs(self.cache_path)
+
+    def signature(self):
+        """ Identifies source directory contents and dataset size """
+
+        source_hash = hashlib.sha1()
+
+        for entry in sorted(os.scandir(self.file_path), key=lambda e: e.name):
+            stat = entry.stat()
+            source_hash.update(f"{entry.name}{stat.st_size}{stat.st_mtime_ns}".encode())
+
+        return {
+            "DATA_PATH": os.path.abspath(self.file_path),
+            "DATASET_SIZE": self.dataset_size,
+            "SOURCE_HASH": source_hash.hexdigest()
+        }
+
+    def read_manifest(self):
+        manifest_path = os.path.join(self.cache_path, "manifest.json")
+        if not os.path.exists(manifest_path): return None
+
+        with open(manifest_path, 'r') as infile:
+            return json.load(infile)
+
+    def build(self, img_list):
+        """ Builds cache from img_list if missing or invalid
+            - Returns image list in cached order """
+
+        signature = self.signature()
+        manifest = self.read_manifest()
+
+        if manifest is not None \
+            and manifest["SIGNATURE"] == signature \
+            and set(self.resolutions).issubset(manifest["RESOLUTIONS"]):
+            return manifest["IMAGES"]
+
+        # Remove manifest first so a partial build is never treated as valid
+        if manifest is not None: os.remove(os.path.join(self.cache_path, "manifest.json"))
+
+        levels = {
+            res: np.lib.format.open_memmap(
+                os.path.join(self.cache_path, f"{res}.npy"), mode="w+", dtype=np.uint8, shape=(len(img_list), res, res, 3))
+            for res in self.resolutions}
+
+        # Each image is decoded once and resized to every resolution
+        for idx, img in enumerate(img_list):
+            img = tf.io.read_file(f"{self.file_path}{img}")
+            img = tf.image.decode_jpeg(img, channels=3)
+            img = tf.image.convert_image_dtype(img, tf.float32)
+
+            for res, level in levels.items():
+                level[idx, ...] = tf.image.convert_image_dtype(tf.image.resize(img, (res, res)), tf.uint8, saturate=True).numpy()
+
+        for level in levels.values():
+            level.flush()
+
+        with open(os.path.join(self.cache_path, "manifest.json"), 'w') as outfile:
+            json.dump({"SIGNATURE": signature, "RESOLUTIONS": self.resolutions, "IMAGES": list(img_list)}, outfile)
+
+        self.levels = {}
+
+        return list(img_list)
+
+    def level(self, res):
+        """ Returns read-only memory map of images at resolution res """
+
+        if res not in self.levels:
+            self.levels[res] = np.load(os.path.join(self.cache_path, f"{res}.npy"), mmap_mode='r')
+
+        return self.levels[res]
+
+
 class ImgLoader:
+
+    """ Loads jpeg images and scales to [-1, 1]
+        - LOADER: 'ram' (decode all into memory), 'generator'
+          (decode in Python generator) or 'parallel' (native tf.data
+          decoding with parallel map), 'memmap' (batches gathered from
+          uint8 PyramidCache memory map, needs CACHE_PATH), defaults
+          to FROM_RAM if absent
+        - DETERMINISTIC: preserve ordering in parallel decoding
+        - CACHE_PATH: if set, images are read from a pre-resized
+          PyramidCache at this location, built on first use
+        - NORMALISATION: 'sample' (per-sample min/max, default), 'global'
+          (dataset min/max, computed once per resolution) or 'fixed'
+        - NORM_BOUNDS: [min, max] for 'fixed' normalisation
+        - DS_CACHE: 'memory' or 'file' to decode each image once per scale
+          with tf.data cache (for 'generator' and 'parallel' loaders) -
+          cache is shared by fade in and stabilise phases and evicted when
+          the next scale starts
+        - DS_CACHE_PATH: directory for 'file' cache, files are prefixed
+          with hash of image list and stale files cleared on start
+        - SHUFFLE_BUFFER: shuffle buffer for cached images, defaults to
+          1024 (or dataset size if smaller) """
+
     def __init__(self, config):
         self.file_path = config["DATA_PATH"]
         dataset_size = config["DATASET_SIZE"]
         self.img_list = os.listdir(self.file_path)
         np.random.shuffle(self.img_list)
         if dataset_size: self.img_list = self.img_list[0:dataset_size]
-    
+
+        if "LOADER" in config:
+            self.loader = config["LOADER"]
+        else:
+            self.loader = "ram" if config.get("FROM_RAM", False) else "generator"
+
+        self.deterministic = config.get("DETERMINISTIC", True)
+
+        if config.get("CACHE_PATH"):
+            self.cache = PyramidCache(config["CACHE_PATH"], self.file_path, dataset_size, config["SCALES"])
+            self.img_list = self.cache.build(self.img_list)
+        elif self.loader == "memmap":
+            raise ValueError("CACHE_PATH required for memmap loader")
+        else:
+            self.cache = None
+
+        self.normalisation = config.get("NORMALISATION", "sample")
+        self.norm_bounds = config.get("NORM_BOUNDS", None)
+        self.global_bounds = {}
+
+        if self.normalisation == "fixed" and self.norm_bounds is None:
+            raise ValueError("NORM_BOUNDS required for fixed normalisation")
+
+        self.ds_cache = config.get("DS_CACHE", None)
+
+        if self.ds_cache == "file":
+            if not config.get("DS_CACHE_PATH"): raise ValueError("DS_CACHE_PATH required for file cache")
+            if not os.path.exists(config["DS_CACHE_PATH"]): os.makedirs(config["DS_CACHE_PATH"])
+
+            # Cache files are only valid for this image list, and partial caches
+            # or lockfiles left by an interrupted run prevent the cache being written
+            list_hash = hashlib.sha1(json.dumps([self.file_path] + sorted(self.img_list)).encode()).hexdigest()[0:8]
+            self.ds_cache_path = f"{config['DS_CACHE_PATH']}{list_hash}_"
+            self.clear_cache_files("")
+        elif self.ds_cache not in [None, "memory"]:
+            raise ValueError(f"Invalid dataset cache: {self.ds_cache}")
+
+        self.shuffle_buffer = config.get("SHUFFLE_BUFFER", np.min([len(self.img_list), 1024]))
+
+        # Unbatched datasets for current scale, shared between phases
+        self.sample_ds = {}
+
+    def get_bounds(self, res):
+        """ Returns precomputed normalisation bounds for resolution res """
+
+        if self.normalisation == "sample":
+            return None
+        elif self.normalisation == "fixed":
+            return self.norm_bounds
+        elif self.normalisation != "global":
+            raise ValueError(f"Invalid normalisation: {self.normalisation}")
+
+        if res not in self.global_bounds:
+            if self.cache:
+                level = self.cache.level(res)
+                chunks = range(0, level.shape[0], 1024)
+                img_min = np.min([level[i:i + 1024].min() for i in chunks]) / 255
+                img_max = np.max([level[i:i + 1024].max() for i in chunks]) / 255
+            else:
+                img_min, img_max = np.inf, -np.inf
+
+                # Also fills dataset cache if used
+                for imgs in self.samples(res).batch(256):
+                    img_min = np.minimum(img_min, tf.reduce_min(imgs).numpy())
+                    img_max = np.maximum(img_max, tf.reduce_max(imgs).numpy())
+
+            self.global_bounds[res] = (float(img_min), float(img_max))
+
+        return self.global_bounds[res]
+
+    def decode(self, file_name, res):
+        """ Reads, decodes and resizes single image """
+
+        img = tf.io.read_file(file_name)
+        img = tf.image.decode_jpeg(img, channels=3)
+        img = tf.image.convert_image_dtype(img, tf.float32)
+        img = tf.image.resize(img, (res, res))
+
+        return img
+
+    def read_cached(self, idx, res):
+        """ Reads single image from cache level res """
+
+        img = tf.numpy_function(lambda i: self.cache.level(res)[i], [idx], tf.uint8)
+        img.set_shape([res, res, 3])
+
+        return tf.image.convert_image_dtype(img, tf.float32)
+
+    def load_img(self, idx, res):
+        if self.cache:
+            return self.read_cached(idx, res)
+        else:
+            return self.decode(f"{self.file_path}{self.img_list[idx]}", res)
+
     def data_loader(self, res):
         imgs = []
 
-        for img in self.img_list:
-            img = tf.io.read_file(f"{self.file_path}{img}")
-            img = tf.image.decode_jpeg(img, channels=3)
-            img = tf.image.convert_image_dtype(img, tf.float32)
-            img = tf.image.resize(img, (res, res))
-            img = (img - tf.reduce_min(img)) / (tf.reduce_max(img) - tf.reduce_min(img))
-            img = (img * 2) - 1
-            imgs.append(img)
+        for idx in range(len(self.img_list)):
+            imgs.append(self.load_img(idx, res))
         
         return imgs
 
     def data_generator(self, res):
-        np.random.shuffle(self.img_list)
+        # Shuffle indices rather than list so cache order is preserved
+        img_order = np.random.permutation(len(self.img_list))
         N = len(self.img_list)
         i = 0
 
         while i < N:
-            img = tf.io.read_file(f"{self.file_path}{self.img_list[i]}")
-            img = tf.image.decode_jpeg(img, channels=3)
-            img = tf.image.convert_image_dtype(img, tf.float32)
-            img = tf.image.resize(img, (res, res))
-            img = (img - tf.reduce_min(img)) / (tf.reduce_max(img) - tf.reduce_min(img))
-            img = (img * 2) - 1
+            img = self.load_img(img_order[i], res)
 
             i += 1
 
             yield img
 
+    def data_pipeline(self, res):
+        """ Native tf.data pipeline with parallel decoding """
+
+        if self.cache:
+            ds = tf.data.Dataset.range(len(self.img_list))
+            load_fn = lambda idx: self.read_cached(idx, res)
+        else:
+            ds = tf.data.Dataset.from_tensor_slices([f"{self.file_path}{img}" for img in self.img_list])
+            load_fn = lambda f: self.decode(f, res)
+
+        ds = ds.shuffle(len(self.img_list), reshuffle_each_iteration=True)
+
+        return ds.map(
+            load_fn,
+            num_parallel_calls=tf.data.experimental.AUTOTUNE,
+            deterministic=self.deterministic)
+
+    def memmap_pipeline(self, res, batch_size):
+        """ Batches of uint8 images gathered from cache memory map,
+            converted per batch - page cache is shared between processes """
+
+        def gather(idx):
+            # Sorted indices give sequential reads from the memory map
+            return self.cache.level(res)[np.sort(idx)]
+
+        ds = tf.data.Dataset.range(len(self.img_list))
+        ds = ds.shuffle(len(self.img_list), reshuffle_each_iteration=True)
+        ds = ds.batch(batch_size, drop_remainder=True)
+        ds = ds.map(
+            lambda idx: tf.ensure_shape(tf.numpy_function(gather, [idx], tf.uint8), [batch_size, res, res, 3]),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE,
+            deterministic=self.deterministic)
+
+        return ds.map(
+            lambda imgs: tf.image.convert_image_dtype(imgs, tf.float32),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    def clear_cache_files(self, res):
+        """ Removes file cache (and lockfiles) at res, or all if res is empty """
+
+        for file_name in glob.glob(f"{self.ds_cache_path}{res}*"):
+            os.remove(file_name)
+
+    def evict(self):
+        """ Releases datasets (and cache files) of previous scale """
+
+        if self.ds_cache == "file":
+            for res in self.sample_ds.keys():
+                self.clear_cache_files(f"{res}.")
+
+        self.sample_ds = {}
+
+    def samples(self, res):
+        """ Returns unbatched dataset at resolution res using selected loader,
+            cached if DS_CACHE set - reused by all datasets at res """
+
+        if res in self.sample_ds:
+            return self.sample_ds[res]
+
+        self.evict()
+
+        if self.loader == "ram":
+            ds = tf.data.Dataset.from_tensor_slices(self.data_loader(res))
+        elif self.loader == "generator":
+            ds = tf.data.Dataset.from_generator(self.data_generator, args=[res], output_types=tf.float32)
+        elif self.loader == "parallel":
+            ds = self.data_pipeline(res)
+        else:
+            raise ValueError(f"Invalid loader: {self.loader}")
+
+        # Images from 'ram' loader are already held in memory
+        if self.ds_cache == "memory" and self.loader != "ram":
+            ds = ds.cache()
+        elif self.ds_cache == "file" and self.loader != "ram":
+            ds = ds.cache(f"{self.ds_cache_path}{res}")
+
+        self.sample_ds[res] = ds
+
+        return ds
+
+    def dataset(self, res, batch_size):
+        """ Returns batched dataset at resolution res using selected
+            loader, with normalisation applied per batch """
+
+        if self.loader == "memmap":
+            ds = self.memmap_pipeline(res, batch_size)
+        else:
+            ds = self.samples(res)
+
+            # Cached images are in first epoch's order, so reshuffled from buffer
+            if self.ds_cache and self.loader != "ram":
+                ds = ds.shuffle(self.shuffle_buffer, reshuffle_each_iteration=True)
+
+            ds = ds.batch(batch_size, drop_remainder=True)
+
+        bounds = self.get_bounds(res)
+        ds = ds.map(lambda imgs: random_flip(normalise_batch(imgs, bounds)), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+        return ds.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+class VolLoader:
+
+    """ Samples axial slices or slabs lazily from memory mapped CT volumes,
+        with the same dataset interface as ImgLoader
+        - DATA_PATH: directory of (D, H, W) .npy volumes, or .raw volumes
+          with .json header sidecar e.g. {"shape": [D, H, W], "dtype": "int16"}
+          and optional "offset", "slope" and "intercept"
+        - HU_WINDOW: [min, max] window scaled to [-1, 1]
+        - NORMALISATION: 'sample' (per-sample min/max), 'volume' (min/max
+          of source volume), 'global' (min/max over all volumes) or
+          'fixed' (HU_WINDOW), defaults to 'fixed' if HU_WINDOW given
+        - VOL_DEPTH: 1 for single slices (repeated to 3 channels), or 3
+          for slabs of consecutive slices stacked as channels
+        - PATCH_SIZE: in-plane size of random patches, whole slice if absent
+        - DATASET_SIZE: samples per epoch, total slices if 0 """
+
+    def __init__(self, config):
+        self.file_path = config["DATA_PATH"]
+        self.hu_window = config.get("HU_WINDOW", None)
+        self.depth = config.get("VOL_DEPTH", 1)
+        self.patch_size = config.get("PATCH_SIZE", None)
+        self.deterministic = config.get("DETERMINISTIC", True)
+
+        if self.depth not in [1, 3]:
+            raise ValueError(f"VOL_DEPTH must be 1 or 3: {self.depth}")
+
+        self.volumes = []
+        self.rescale = []
+
+        for vol_name in sorted(os.listdir(self.file_path)):
+            if vol_name.endswith(".npy"):
+                self.volumes.append(np.load(f"{self.file_path}{vol_name}", mmap_mode='r'))
+                self.rescale.append((1.0, 0.0))
+
+            elif vol_name.endswith(".raw"):
+                with open(f"{self.file_path}{vol_name[:-4]}.json", 'r') as infile:
+                    header = json.load(infile)
+
+                self.volumes.append(np.memmap(
+                    f"{self.file_path}{vol_name}", dtype=header["dtype"], mode='r',
+                    offset=header.get("offset", 0), shape=tuple(header["shape"])))
+                self.rescale.append((header.get("slope", 1.0), header.get("intercept", 0.0)))
+
+        if len(self.volumes) == 0:
+            raise ValueError(f"No volumes found in {self.file_path}")
+
+        self.vol_shapes = np.array([vol.shape for vol in self.volumes], dtype=np.int32)
+
+        if config["DATASET_SIZE"]:
+            self.num_samples = config["DATASET_SIZE"]
+        else:
+            self.num_samples = int(np.sum(self.vol_shapes[:, 0]))
+
+        self.normalisation = config.get("NORMALISATION", "fixed" if self.hu_window else "sample")
+
+        if self.normalisation in ["volume", "global"]:
+            self.vol_bounds = np.array([self.volume_bounds(i) for i in range(len(self.volumes))], dtype=np.float32)
+        elif self.normalisation == "fixed" and self.hu_window is None:
+            raise ValueError("HU_WINDOW required for fixed normalisation")
+        elif self.normalisation not in ["sample", "fixed"]:
+            raise ValueError(f"Invalid normalisation: {self.normalisation}")
+
+    def volume_bounds(self, vol_idx):
+        """ Min/max of volume in HU, read in chunks of slices """
+
+        slope, intercept = self.rescale[vol_idx]
+        vol = self.volumes[vol_idx]
+        chunks = range(0, vol.shape[0], 64)
+        vol_min = np.min([vol[i:i + 64].min() for i in chunks]) * slope + intercept
+        vol_max = np.max([vol[i:i + 64].max() for i in chunks]) * slope + intercept
+
+        return min(vol_min, vol_max), max(vol_min, vol_max)
+
+    def read(self, vol_idx, z, y, x, h, w):
+        """ Reads (h, w, depth) slab from volume in HU """
+
+        slope, intercept = self.rescale[vol_idx]
+        slab = self.volumes[vol_idx][z:z + self.depth, y:y + h, x:x + w]
+        slab = np.transpose(slab, [1, 2, 0]).astype(np.float32)
+
+        return slab * slope + intercept
+
+    def sample(self, res):
+        """ Draws random slab location and reads it
+            - Returns slab and index of source volume """
+
+        vol_shapes = tf.constant(self.vol_shapes)
+        vol_idx = tf.random.uniform([], 0, len(self.volumes), dtype=tf.int32)
+        vol_shape = vol_shapes[vol_idx]
+        z = tf.random.uniform([], 0, vol_shape[0] - self.depth + 1, dtype=tf.int32)
+
+        if self.patch_size:
+            h, w = self.patch_size, self.patch_size
+            y = tf.random.uniform([], 0, vol_shape[1] - h + 1, dtype=tf.int32)
+            x = tf.random.uniform([], 0, vol_shape[2] - w + 1, dtype=tf.int32)
+        else:
+            h, w = vol_shape[1], vol_shape[2]
+            y, x = 0, 0
+
+        img = tf.numpy_function(self.read, [vol_idx, z, y, x, h, w], tf.float32)
+        img.set_shape([None, None, self.depth])
+        img = tf.image.resize(img, (res, res))
+
+        if self.depth == 1:
+            img = tf.tile(img, [1, 1, 3])
+
+        return img, vol_idx
+
+    def normalise(self, imgs, vol_idx):
+        if self.normalisation == "sample":
+            return normalise_batch(imgs)
+        elif self.normalisation == "fixed":
+            return normalise_batch(imgs, self.hu_window)
+        elif self.normalisation == "global":
+            return normalise_batch(imgs, (self.vol_bounds[:, 0].min(), self.vol_bounds[:, 1].max()))
+        else:
+            bounds = tf.reshape(tf.gather(self.vol_bounds, vol_idx), [-1, 2, 1, 1, 1])
+            return normalise_batch(imgs, (bounds[:, 0], bounds[:, 1]))
+
+    def dataset(self, res, batch_size):
+        """ Returns batched dataset of num_samples random slabs at resolution res """
+
+        ds = tf.data.Dataset.range(self.num_samples)
+        ds = ds.map(
+            lambda _: self.sample(res),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE,
+            deterministic=self.deterministic)
+
+        ds = ds.batch(batch_size, drop_remainder=True)
+        ds = ds.map(lambda imgs, vol_idx: random_flip(self.normalise(imgs, vol_idx)), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+        return ds.prefetch(tf.data.experimental.AUTOTUNE)
+
 
 class DiffAug:
 
     """ https://arxiv.org/abs/2006.10738
-        https://github.com/mit-han-lab/data-efficient-gans """
+        https://github.com/mit-han-lab/data-efficient-gans
+        - colour transforms are fused into one affine op, and translation
+          and cutout into one gather with a combined mask
+        - p: probability each sample is augmented, held in a variable so
+          it can be changed without retracing - only selected samples are
+          gathered and augmented, then scattered back into the batch """
     
     def __init__(self, aug_config):
         self.aug_config = aug_config
+        self.p = tf.Variable(aug_config.get("p", 1.0), dtype=tf.float32, trainable=False)
 
-    # Random brightness in range [-0.5, 0.5]
-    def brightness(self, x):
-        factor = tf.random.uniform((x.shape[0], 1, 1, 1)) - 0.5
-        return x + factor
-    
-    # Random saturation in range [0, 2]
-    def saturation(self, x):
-        factor = tf.random.uniform((x.shape[0], 1, 1, 1)) * 2
-        x_mean = tf.reduce_mean(x, axis=(1, 2, 3), keepdims=True)
-        return (x - x_mean) * factor + x_mean
-
-    # Random contrast in range [0.5, 1.5]
-    def contrast(self, x):
-        factor = tf.random.uniform((x.shape[0], 1, 1, 1)) + 0.5
-        x_mean = tf.reduce_mean(x, axis=-1, keepdims=True)
-        return (x - x_mean) * factor + x_mean
-    
-    # Random translation by ratio 0.125
-    def translation(self, x, ratio=0.125):
-        batch_size = tf.shape(x)[0]
-        image_size = tf.shape(x)[1:3]
-        shift = tf.cast(tf.cast(image_size, tf.float32) * ratio + 0.5, tf.int32)
-        translation_x = tf.random.uniform([batch_size, 1], -shift[0], shift[0] + 1, dtype=tf.int32)
-        translation_y = tf.random.uniform([batch_size, 1], -shift[1], shift[1] + 1, dtype=tf.int32)
-        grid_x = tf.clip_by_value(tf.expand_dims(tf.range(image_size[0], dtype=tf.int32), 0) + translation_x + 1, 0, image_size[0] + 1)
-        grid_y = tf.clip_by_value(tf.expand_dims(tf.range(image_size[1], dtype=tf.int32), 0) + translation_y + 1, 0, image_size[1] + 1)
-        x = tf.gather_nd(tf.pad(x, [[0, 0], [1, 1], [0, 0], [0, 0]]), tf.expand_dims(grid_x, -1), batch_dims=1)
-        x = tf.transpose(tf.gather_nd(tf.pad(tf.transpose(x, [0, 2, 1, 3]), [[0, 0], [1, 1], [0, 0], [0, 0]]), tf.expand_dims(grid_y, -1), batch_dims=1), [0, 2, 1, 3])
-        
-        return x
+        # Row and column index grids cached per (height, width)
+        self.grids = {}
+
+    def get_grids(self, batch_size, height, width):
+        """ Returns flat offset of each sample, row and column index grids
+            - batch_size can be dynamic e.g. a selected sub-batch """
+
+        if (height, width) not in self.grids:
+            self.grids[(height, width)] = (
+                np.arange(height, dtype=np.int32).reshape([1, height, 1]),
+                np.arange(width, dtype=np.int32).reshape([1, 1, width]))
+
+        row_grid, col_grid = self.grids[(height, width)]
+        batch_grid = tf.reshape(tf.range(batch_size, dtype=tf.int32) * height * width, [-1, 1, 1])
+
+        return batch_grid, row_grid, col_grid
+
+    def colour(self, x):
+        """ Random brightness in range [-0.5, 0.5], then saturation in range
+            [0, 2] about sample mean m, then contrast in range [0.5, 1.5] about
+            channel mean mc, combined as one affine op:
+            x = c * s * x + (s - c * s) * mc + (1 - s) * m + b """
+
+        shape = tf.stack([tf.shape(x)[0], 1, 1, 1])
+        b = tf.random.uniform(shape) - 0.5
+        s = tf.random.uniform(shape) * 2
+        c = tf.random.uniform(shape) + 0.5
+
+        mc = tf.reduce_mean(x, axis=-1, keepdims=True)
+        m = tf.reduce_mean(mc, axis=[1, 2], keepdims=True)
+        cs = c * s
+
+        return cs * x + (s - cs) * mc + (1 - s) * m + b
+
+    def translation_cutout(self, x, translation_ratio=0.125, cutout_ratio=0.5):
+        """ Random translation by translation_ratio (zero filled) followed by
+            random cutout by cutout_ratio, as one gather from clamped source
+            indices, with out of bounds and cut out pixels masked to zero """
 
-    # Random cutout by ratio 0.5
-    def cutout(self, x, ratio=0.5):
         batch_size = tf.shape(x)[0]
-        image_size = tf.shape(x)[1:3]
-        cutout_size = tf.cast(tf.cast(image_size, tf.float32) * ratio + 0.5, tf.int32)
-        offset_x = tf.random.uniform([tf.shape(x)[0], 1, 1], maxval=image_size[0] + (1 - cutout_size[0] % 2), dtype=tf.int32)
-        offset_y = tf.random.uniform([tf.shape(x)[0], 1, 1], maxval=image_size[1] + (1 - cutout_size[1] % 2), dtype=tf.int32)
-        grid_batch, grid_x, grid_y = tf.meshgrid(tf.range(batch_size, dtype=tf.int32), tf.range(cutout_size[0], dtype=tf.int32), tf.range(cutout_size[1], dtype=tf.int32), indexing='ij')
-        cutout_grid = tf.stack([grid_batch, grid_x + offset_x - cutout_size[0] // 2, grid_y + offset_y - cutout_size[1] // 2], axis=-1)
-        mask_shape = tf.stack([batch_size, image_size[0], image_size[1]])
-        cutout_grid = tf.maximum(cutout_grid, 0)
-        cutout_grid = tf.minimum(cutout_grid, tf.reshape(mask_shape - 1, [1, 1, 1, 3]))
-        mask = tf.maximum(1 - tf.scatter_nd(cutout_grid, tf.ones([batch_size, cutout_size[0], cutout_size[1]], dtype=tf.float32), mask_shape), 0)
-        x = x * tf.expand_dims(mask, axis=3)
-        
+        _, height, width, channels = x.shape
+        batch_grid, row_grid, col_grid = self.get_grids(batch_size, height, width)
+        mask = None
+
+        if self.aug_config["translation"]:
+            shift_h = int(height * translation_ratio + 0.5)
+            shift_w = int(width * translation_ratio + 0.5)
+            translation_h = tf.random.uniform(tf.stack([batch_size, 1, 1]), -shift_h, shift_h + 1, dtype=tf.int32)
+            translation_w = tf.random.uniform(tf.stack([batch_size, 1, 1]), -shift_w, shift_w + 1, dtype=tf.int32)
+            rows = row_grid + translation_h
+            cols = col_grid + translation_w
+            mask = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+
+            idx = batch_grid + tf.clip_by_value(rows, 0, height - 1) * width + tf.clip_by_value(cols, 0, width - 1)
+            x = tf.gather(tf.reshape(x, [-1, channels]), idx)
+
+        if self.aug_config["cutout"]:
+            cutout_h = int(height * cutout_ratio + 0.5)
+            cutout_w = int(width * cutout_ratio + 0.5)
+            lower_h = tf.random.uniform(tf.stack([batch_size, 1, 1]), maxval=height + (1 - cutout_h % 2), dtype=tf.int32) - cutout_h // 2
+            lower_w = tf.random.uniform(tf.stack([batch_size, 1, 1]), maxval=width + (1 - cutout_w % 2), dtype=tf.int32) - cutout_w // 2
+            in_box = (row_grid >= lower_h) & (row_grid < lower_h + cutout_h) & (col_grid >= lower_w) & (col_grid < lower_w + cutout_w)
+            keep = tf.logical_not(in_box)
+            mask = keep if mask is None else mask & keep
+
+        if mask is None:
+            return x
+
+        return x * tf.cast(tf.expand_dims(mask, axis=3), x.dtype)
+
+    def augment_samples(self, x):
+        if self.aug_config["colour"]: x = self.colour(x)
+        if self.aug_config["translation"] or self.aug_config["cutout"]: x = self.translation_cutout(x)
+
         return x
-    
+
+    def augment_selected(self, x, idx):
+        """ Augments only samples at idx, leaving the rest untouched """
+
+        return tf.tensor_scatter_nd_update(x, idx, self.augment_samples(tf.gather_nd(x, idx)))
+
     def augment(self, x):
-        if self.aug_config["colour"]: x = self.contrast(self.saturation(self.brightness(x)))
-        if self.aug_config["translation"]: x = self.translation(x)
-        if self.aug_config["cutout"]: x = self.cutout(x)
+        idx = tf.where(tf.random.uniform([tf.shape(x)[0]]) < self.p)
+        num_selected = tf.shape(idx)[0]
 
-        return x
+        # Whole batch needs no gather/scatter, and no samples need no work
+        return tf.cond(
+            num_selected == tf.shape(x)[0],
+            lambda: self.augment_samples(x),
+            lambda: tf.cond(num_selected > 0, lambda: self.augment_selected(x, idx), lambda: x))
 
 
 if __name__ == "__main__":
@@ -118,7 +616,7 @@ if __name__ == "__main__":
     TestAug = DiffAug({"colour": True, "translation": True, "cutout": True})
 
     train_ds = tf.data.Dataset.from_generator(
-        TestLoader.data_generator, args=[64, 1], output_types=tf.float32)
+        TestLoader.data_generator, args=[64], output_types=tf.float32)
 
     for img in train_ds.batch(MB_SIZE):
         img = TestAug.augment(img)
@@ -0,0 +1,56 @@
+import json
+import os
+import tensorflow as tf
+
+
+def set_cpu_devices(num_devices):
+    """ Splits the physical CPU into num_devices logical devices so
+        multi-replica training can be run without GPUs
+        - must be called before any TensorFlow ops are run """
+
+    cpus = tf.config.list_physical_devices("CPU")
+    tf.config.set_logical_device_configuration(
+        cpus[0], [tf.config.LogicalDeviceConfiguration() for _ in range(num_devices)])
+
+
+def get_strategy(config):
+    """ Returns distribution strategy selected by STRATEGY in config
+        - None (default): single device
+        - 'mirrored': all local GPUs, or NUM_CPU_DEVICES logical CPUs
+        - 'multiworker': across hosts listed in TF_CONFIG environment variable """
+
+    strategy = config.get("STRATEGY")
+    num_cpu_devices = config.get("NUM_CPU_DEVICES")
+
+    if strategy is None:
+        return tf.distribute.get_strategy()
+
+    elif strategy == "mirrored":
+        if num_cpu_devices:
+            set_cpu_devices(num_cpu_devices)
+            devices = [device.name for device in tf.config.list_logical_devices("CPU")]
+
+            # NCCL all-reduce is GPU only
+            return tf.distribute.MirroredStrategy(devices=devices, cross_device_ops=tf.distribute.ReductionToOneDevice())
+        else:
+            return tf.distribute.MirroredStrategy()
+
+    elif strategy == "multiworker":
+        if num_cpu_devices: set_cpu_devices(num_cpu_devices)
+        return tf.distribute.MultiWorkerMirroredStrategy()
+
+    else:
+        raise ValueError(f"Invalid strategy: {strategy}")
+
+
+def is_chief():
+    """ Whether this process is the chief worker (always True if not multiworker),
+        used so only one worker writes checkpoints """
+
+    tf_config = json.loads(os.environ.get("TF_CONFIG", "{}"))
+    task = tf_config.get("task", {"type": "worker", "index": 0})
+
+    if "chief" in tf_config.get("cluster", {}):
+        return task["type"] == "chief"
+    else:
+        return task["type"] == "worker" and task["index"] == 0
@@ -0,0 +1,224 @@
+import hashlib
+import json
+import numpy as np
+import os
+import tensorflow as tf
+import tensorflow.keras as keras
+
+
+class RandomConvExtractor:
+
+    """ Small conv net with fixed, seeded random weights - scores are not
+        comparable with published FID/KID but need no download, so can be
+        used offline on CPU to compare runs and detect convergence
+        - seed: weight initialisation seed
+        - input_res: images are resized to this resolution """
+
+    def __init__(self, seed=0, input_res=64):
+        self.name = f"random_{seed}"
+        self.input_res = input_res
+
+        # Float32 regardless of mixed precision policy
+        self.model = keras.Sequential(
+            [keras.layers.InputLayer((input_res, input_res, 3))]
+            + [keras.layers.Conv2D(filters=ch, kernel_size=(3, 3), strides=(2, 2), padding="SAME", activation="relu", dtype="float32",
+                kernel_initializer=keras.initializers.HeNormal(seed=seed + i)) for i, ch in enumerate([32, 64, 128, 256])]
+            + [keras.layers.GlobalAveragePooling2D(dtype="float32")])
+
+        self.extract = tf.function(lambda imgs: self.model(tf.image.resize(imgs, (input_res, input_res))))
+
+    def __call__(self, imgs):
+        return self.extract(imgs)
+
+
+class InceptionExtractor:
+
+    """ InceptionV3 pool features as used for standard FID/KID
+        - downloads ImageNet weights on first use """
+
+    def __init__(self):
+        self.name = "inception"
+        self.model = keras.applications.InceptionV3(include_top=False, pooling="avg", input_shape=(299, 299, 3), weights="imagenet")
+
+        # Images already in [-1, 1] as Inception expects
+        self.extract = tf.function(lambda imgs: self.model(tf.image.resize(imgs, (299, 299))))
+
+    def __call__(self, imgs):
+        return self.extract(imgs)
+
+
+class SavedModelExtractor:
+
+    """ Any SavedModel mapping images in [-1, 1] to (N, features)
+        - model_path: SavedModel directory """
+
+    def __init__(self, model_path):
+        self.name = os.path.basename(os.path.normpath(model_path))
+        self.model = tf.saved_model.load(model_path)
+
+    def __call__(self, imgs):
+        return self.model(imgs)
+
+
+def get_extractor(name):
+    """ Returns feature extractor - 'random' (default), 'inception'
+        or a path to a SavedModel """
+
+    if name == "random":
+        return RandomConvExtractor()
+    elif name == "inception":
+        return InceptionExtractor()
+    else:
+        return SavedModelExtractor(name)
+
+
+class FeatureStats:
+
+    """ Running mean and covariance of features, accumulated batch by
+        batch in float64 so features need not all be held in memory
+        - max_samples: size of uniform random sample of features kept
+          for KID, by reservoir sampling so later batches are represented
+        - seed: reservoir sampling seed """
+
+    def __init__(self, max_samples=1000, seed=0):
+        self.max_samples = max_samples
+        self.rng = np.random.RandomState(seed)
+        self.n = 0
+        self.feature_sum = None
+        self.outer_sum = None
+        self.samples = None
+
+    def update(self, features):
+        features = np.asarray(features, dtype=np.float64)
+
+        if self.feature_sum is None:
+            self.feature_sum = np.zeros(features.shape[1])
+            self.outer_sum = np.zeros([features.shape[1], features.shape[1]])
+            self.samples = np.zeros([self.max_samples, features.shape[1]])
+
+        # Feature t replaces a random reservoir entry with probability max_samples / (t + 1)
+        t = np.arange(self.n, self.n + features.shape[0])
+        idx = np.where(t < self.max_samples, t, self.rng.randint(0, t + 1))
+        keep = idx < self.max_samples
+        self.samples[idx[keep]] = features[keep]
+
+        self.n += features.shape[0]
+        self.feature_sum += features.sum(axis=0)
+        self.outer_sum += features.T @ features
+
+    def mean_cov(self):
+        mean = self.feature_sum / self.n
+        cov = (self.outer_sum - self.n * np.outer(mean, mean)) / (self.n - 1)
+
+        return mean, cov
+
+    def get_samples(self):
+        return self.samples[0:np.min([self.n, self.max_samples])]
+
+    def save(self, file_name):
+        mean, cov = self.mean_cov()
+        np.savez(file_name, mean=mean, cov=cov, samples=self.get_samples(), n=self.n)
+
+    @staticmethod
+    def load(file_name):
+        """ Returns mean, covariance and samples saved by save """
+
+        stats = np.load(file_name)
+
+        return stats["mean"], stats["cov"], stats["samples"]
+
+
+def frechet_distance(mean_1, cov_1, mean_2, cov_2):
+    """ FID between two Gaussians - trace of sqrt(cov_1 @ cov_2) is computed from
+        eigenvalues of the product, which are real and non-negative for PSD inputs """
+
+    eigenvalues = np.linalg.eigvals(cov_1 @ cov_2)
+    trace_sqrt = np.sum(np.sqrt(np.clip(eigenvalues.real, 0, None)))
+
+    return float(np.sum(np.square(mean_1 - mean_2)) + np.trace(cov_1) + np.trace(cov_2) - 2 * trace_sqrt)
+
+
+def kernel_distance(features_1, features_2, num_subsets=100, subset_size=1000):
+    """ KID - unbiased MMD with cubic polynomial kernel, averaged over random subsets """
+
+    rng = np.random.RandomState(0)
+    dims = features_1.shape[1]
+    m = np.min([features_1.shape[0], features_2.shape[0], subset_size])
+    total = 0.0
+
+    for _ in range(num_subsets):
+        x = features_1[rng.choice(features_1.shape[0], m, replace=False)]
+        y = features_2[rng.choice(features_2.shape[0], m, replace=False)]
+        a = (x @ x.T / dims + 1) ** 3 + (y @ y.T / dims + 1) ** 3
+        b = (x @ y.T / dims + 1) ** 3
+        total += (a.sum() - np.diag(a).sum()) / (m - 1) - b.sum() * 2 / m
+
+    return float(total / num_subsets / m)
+
+
+class Evaluator:
+
+    """ Scores generator samples against real images with FID and KID
+        - DataLoader: ImgLoader or VolLoader for real images
+        - FID_EXTRACTOR: 'random' (default), 'inception' or SavedModel path
+        - FID_NUM_REAL/FID_NUM_FAKE: number of real/generated images scored
+        - FID_BATCH: batch size for feature extraction
+        - FID_CACHE_PATH: directory for cached real feature statistics
+
+        Real statistics are computed once per scale and cached to disk """
+
+    def __init__(self, config, DataLoader):
+        self.DataLoader = DataLoader
+        self.extractor = get_extractor(config.get("FID_EXTRACTOR", "random"))
+        self.num_real = config.get("FID_NUM_REAL", 2048)
+        self.num_fake = config.get("FID_NUM_FAKE", 2048)
+        self.batch_size = config.get("FID_BATCH", 64)
+        self.kid_size = config.get("KID_SUBSET", 1000)
+
+        self.cache_path = config.get("FID_CACHE_PATH", f"{config['SAVE_PATH']}fid_stats/")
+        if not os.path.exists(self.cache_path): os.makedirs(self.cache_path)
+
+        # Cache is specific to dataset and how it is loaded, extractor and number of images
+        data_config = {key: config.get(key) for key in ["DATA_PATH", "DATASET_SIZE", "LOADER", "NORMALISATION", "NORM_BOUNDS", "HU_WINDOW"]}
+        data_hash = hashlib.md5(json.dumps(data_config, sort_keys=True).encode()).hexdigest()[0:8]
+        self.cache_prefix = f"{self.cache_path}{data_hash}_{self.extractor.name}_{self.num_real}"
+        self.real = {}
+
+    def real_stats(self, res):
+        """ Returns real mean, covariance and samples at res, from cache if available """
+
+        if res in self.real:
+            return self.real[res]
+
+        file_name = f"{self.cache_prefix}_{res}.npz"
+
+        if not os.path.exists(file_name):
+            stats = FeatureStats(self.kid_size)
+
+            for imgs in self.DataLoader.dataset(res, self.batch_size):
+                stats.update(self.extractor(imgs))
+                if stats.n >= self.num_real: break
+
+            stats.save(file_name)
+
+        self.real[res] = FeatureStats.load(file_name)
+
+        return self.real[res]
+
+    def score(self, Generator, scale, res, latent_dims):
+        """ Returns dict of FID and KID for generator at scale,
+            streaming samples in batches """
+
+        real_mean, real_cov, real_samples = self.real_stats(res)
+        stats = FeatureStats(self.kid_size)
+
+        for start in range(0, self.num_fake, self.batch_size):
+            latent_noise = tf.random.normal([np.min([self.batch_size, self.num_fake - start]), latent_dims])
+            stats.update(self.extractor(Generator(latent_noise, scale, training=False)))
+
+        fake_mean, fake_cov = stats.mean_cov()
+
+        return {
+            "fid": frechet_distance(real_mean, real_cov, fake_mean, fake_cov),
+            "kid": kernel_distance(real_samples, stats.get_samples(), subset_size=self.kid_size)
+        }
@@ -0,0 +1,135 @@
+import numpy as np
+import tensorflow as tf
+
+
+MSSSIM_WEIGHTS = [0.0448, 0.2856, 0.3001, 0.2363, 0.1333]
+
+
+class StreamingStats:
+
+    """ Constant memory summary of a stream of values - mean, std,
+        min/max and percentiles from a fixed-bin histogram sketch
+        - lower/upper: histogram range, values outside are clipped
+        - num_bins: histogram resolution, percentiles are accurate
+          to (upper - lower) / num_bins """
+
+    def __init__(self, lower, upper, num_bins=1000):
+        self.edges = np.linspace(lower, upper, num_bins + 1)
+        self.hist = np.zeros(num_bins, dtype=np.int64)
+        self.n = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self.n += values.size
+        self.total += values.sum()
+        self.total_sq += np.square(values).sum()
+        self.min = np.min([self.min, values.min()])
+        self.max = np.max([self.max, values.max()])
+        self.hist += np.histogram(np.clip(values, self.edges[0], self.edges[-1]), bins=self.edges)[0]
+
+    def percentile(self, q):
+        """ Upper edge of bin containing the qth percentile """
+
+        idx = np.searchsorted(np.cumsum(self.hist), q / 100 * self.n)
+
+        return float(self.edges[np.min([idx + 1, len(self.edges) - 1])])
+
+    def result(self):
+        mean = self.total / self.n
+
+        return {
+            "mean": float(mean),
+            "std": float(np.sqrt(np.max([self.total_sq / self.n - mean ** 2, 0.0]))),
+            "min": float(self.min),
+            "max": float(self.max),
+            "p5": self.percentile(5),
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "n": int(self.n)
+        }
+
+
+def msssim_params(res, filter_size=11):
+    """ MS-SSIM needs each of its scales to be at least filter_size, so at small
+        resolutions the filter is shrunk and the coarsest scales dropped, with
+        remaining power factors renormalised
+        - Returns power factors and filter size """
+
+    filter_size = int(np.min([filter_size, res]))
+    num_scales = int(np.clip(np.floor(np.log2(res / filter_size)) + 1, 1, len(MSSSIM_WEIGHTS)))
+    power_factors = np.array(MSSSIM_WEIGHTS[0:num_scales])
+
+    return (power_factors / power_factors.sum()).tolist(), filter_size
+
+
+class ImageQuality:
+
+    """ Streams batches of image pairs in [-1, 1] through MS-SSIM and PSNR,
+        keeping running aggregates so memory is constant in dataset size
+        - res: image resolution
+        - max_psnr: PSNR of identical images is clipped to this value """
+
+    def __init__(self, res, max_psnr=100.0, num_bins=1000):
+        power_factors, filter_size = msssim_params(res)
+        self.max_psnr = max_psnr
+        self.stats = {
+            "ms_ssim": StreamingStats(0.0, 1.0, num_bins),
+            "psnr": StreamingStats(0.0, max_psnr, num_bins)
+        }
+
+        @tf.function
+        def metrics(imgs_a, imgs_b):
+            # Scaled to [0, 1] so SSIM components are non-negative
+            imgs_a = (tf.cast(imgs_a, tf.float32) + 1) / 2
+            imgs_b = (tf.cast(imgs_b, tf.float32) + 1) / 2
+            ms_ssim = tf.image.ssim_multiscale(imgs_a, imgs_b, max_val=1.0, power_factors=power_factors, filter_size=filter_size)
+            psnr = tf.minimum(tf.image.psnr(imgs_a, imgs_b, max_val=1.0), max_psnr)
+
+            return ms_ssim, psnr
+
+        self.metrics = metrics
+
+    def update(self, imgs_a, imgs_b):
+        """ Adds batch of image pairs, returns per-pair MS-SSIM and PSNR """
+
+        ms_ssim, psnr = self.metrics(imgs_a, imgs_b)
+        self.stats["ms_ssim"].update(ms_ssim.numpy())
+        self.stats["psnr"].update(psnr.numpy())
+
+        return ms_ssim, psnr
+
+    def result(self):
+        return {name: stats.result() for name, stats in self.stats.items()}
+
+
+def sample_diversity(Generator, scale, res, latent_dims, num_pairs=512, batch_size=64):
+    """ MS-SSIM/PSNR between pairs of generated images, as in PGGAN - lower
+        MS-SSIM means more diverse samples, compare with real image pairs """
+
+    quality = ImageQuality(res)
+
+    for start in range(0, num_pairs, batch_size):
+        n = np.min([batch_size, num_pairs - start])
+        imgs = Generator(tf.random.normal([2 * n, latent_dims]), scale, training=False)
+        quality.update(imgs[0:n], imgs[n:])
+
+    return quality.result()
+
+
+def dataset_diversity(dataset, res, num_pairs=512):
+    """ MS-SSIM/PSNR between pairs of real images from batched dataset """
+
+    quality = ImageQuality(res)
+    count = 0
+
+    for imgs in dataset:
+        n = imgs.shape[0] // 2
+        quality.update(imgs[0:n], imgs[n:2 * n])
+        count += n
+        if count >= num_pairs: break
+
+    return quality.result()
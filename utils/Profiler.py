@@ -0,0 +1,101 @@
+import contextlib
+import numpy as np
+import time
+import tensorflow as tf
+
+
+class StepProfiler:
+
+    """ Records wall time per phase of training and writes it as
+        TensorBoard scalars with metrics, images/sec, fade alpha and
+        augmentation probability
+        - log_path: TensorBoard log directory
+        - log_every: number of training steps between writes
+        - profile_steps: optional [start, stop] steps to capture a tf.profiler trace
+        - initial_step: step count to start from e.g. when resuming
+
+        In-graph phases (critic, generator, EMA) are timed by train_step itself
+        and kept as tensors until written, so logging does not force a sync
+        every step """
+
+    def __init__(self, log_path, log_every=100, profile_steps=None, initial_step=0):
+        self.log_path = log_path
+        self.log_every = log_every
+        self.profile_steps = profile_steps
+        self.step = initial_step
+        self.profiling = False
+
+        self.summary_writer = tf.summary.create_file_writer(log_path)
+        self.times = {}
+        self.step_times = []
+        self.num_imgs = 0
+        self.window_start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """ Times block of Python code e.g. waiting for data, rendering samples """
+
+        start = time.perf_counter()
+        yield
+        self.times.setdefault(name, []).append(time.perf_counter() - start)
+
+    def record_step(self, timings, batch_size, Model):
+        """ Records one training step
+            - timings: dict of phase times returned by train_step
+            - batch_size: number of real images consumed by step """
+
+        self.step_times.append(timings)
+        self.num_imgs += batch_size
+        self.step += 1
+
+        if self.profile_steps is not None:
+            if self.step == self.profile_steps[0]:
+                tf.profiler.experimental.start(self.log_path)
+                self.profiling = True
+            elif self.step == self.profile_steps[1] and self.profiling:
+                tf.profiler.experimental.stop()
+                self.profiling = False
+
+        if self.step % self.log_every == 0:
+            self.flush(Model)
+
+    def flush(self, Model):
+        """ Writes mean time per phase (ms) since last write, with current
+            metrics, images/sec and fade alpha """
+
+        if not self.step_times and not self.times: return
+
+        # Converting timings waits for outstanding steps, so images/sec is measured after
+        for step_timings in self.step_times:
+            for name, value in step_timings.items():
+                self.times.setdefault(name, []).append(float(value))
+
+        elapsed = time.perf_counter() - self.window_start
+
+        with self.summary_writer.as_default():
+            for name, values in self.times.items():
+                tf.summary.scalar(f"time/{name}", np.mean(values) * 1000, step=self.step)
+
+            for name, metric in Model.metric_dict.items():
+                tf.summary.scalar(f"metrics/{name}", metric.result(), step=self.step)
+
+            tf.summary.scalar("throughput/img_per_sec", self.num_imgs / elapsed, step=self.step)
+            tf.summary.scalar("fade/alpha", Model.alpha if Model.fade else 1.0, step=self.step)
+
+            if Model.Aug: tf.summary.scalar("augment/p", Model.Aug.p, step=self.step)
+
+        self.times = {}
+        self.step_times = []
+        self.num_imgs = 0
+        self.window_start = time.perf_counter()
+
+    def log_scalars(self, scalars):
+        """ Writes dict of scalars e.g. evaluation scores at current step """
+
+        with self.summary_writer.as_default():
+            for name, value in scalars.items():
+                tf.summary.scalar(name, value, step=self.step)
+
+    def close(self):
+        if self.profiling: tf.profiler.experimental.stop()
+        self.summary_writer.close()
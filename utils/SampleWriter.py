@@ -0,0 +1,82 @@
+import numpy as np
+import queue
+import threading
+import tensorflow as tf
+
+
+def tile_images(imgs, min_size=256):
+    """ Tiles batch of images (N, H, W, C) in [-1, 1] into a single
+        uint8 grid image with one reshape, upscaled with nearest
+        neighbour until at least min_size pixels wide """
+
+    N, H, W, C = imgs.shape
+    cols = int(np.ceil(np.sqrt(N)))
+    rows = int(np.ceil(N / cols))
+
+    imgs = np.clip((imgs / 2 + 0.5) * 255 + 0.5, 0, 255).astype(np.uint8)
+
+    # Pad with blank images to fill last row
+    if rows * cols > N:
+        imgs = np.concatenate([imgs, np.zeros((rows * cols - N, H, W, C), dtype=np.uint8)], axis=0)
+
+    grid = imgs.reshape(rows, cols, H, W, C).transpose(0, 2, 1, 3, 4).reshape(rows * H, cols * W, C)
+
+    upscale = int(np.ceil(min_size / (cols * W)))
+
+    if upscale > 1:
+        grid = np.repeat(np.repeat(grid, upscale, axis=0), upscale, axis=1)
+
+    return grid
+
+
+class SampleWriter:
+
+    """ Writes sample image grids as PNGs from a background thread
+        - max_queue: number of frames waiting to be written - if the
+          writer falls behind, the oldest waiting frame is dropped
+        - min_size: minimum width of written grid in pixels """
+
+    def __init__(self, max_queue=2, min_size=256):
+        self.min_size = min_size
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+
+            if item is None:
+                self.queue.task_done()
+                break
+
+            imgs, file_name = item
+            grid = tile_images(imgs, self.min_size)
+            tf.io.write_file(file_name, tf.io.encode_png(grid))
+            self.queue.task_done()
+
+    def write(self, imgs, file_name):
+        """ Queues images in [-1, 1] for writing to file_name """
+
+        # Copy off device on calling thread so tensor can be released
+        item = (np.asarray(imgs), file_name)
+
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                break
+
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def close(self):
+        """ Writes remaining frames and stops writer thread """
+
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,65 @@
+import numpy as np
+import tensorflow as tf
+
+from networks.Networks import Generator
+from utils.TrainFuncs import get_weight_dict
+
+
+def load_ema_generator(config, checkpoint_path, scale_idx):
+    """ Builds EMA generator alone, without discriminator or optimisers,
+        and restores its weights from a training checkpoint
+        - config: hyperparameter config
+        - checkpoint_path: checkpoint saved by Checkpointer
+        - scale_idx: highest scale to build """
+
+    generator = Generator(config=config, constraint_type=None)
+    generator.build_scale(scale_idx)
+
+    # Keys match 'ema_generator' entries written by Checkpointer
+    live = tf.Module()
+    live.state = {f"ema_generator/{key}": weight for key, weight in get_weight_dict(generator).items()}
+    status = tf.train.Checkpoint(state=live).restore(checkpoint_path)
+    status.assert_existing_objects_matched().expect_partial()
+
+    return generator
+
+
+def export_generator(generator, save_path, scale_idx, latent_dims):
+    """ Saves generator at a single scale, without fade in, as a SavedModel
+        with a batched serving signature (None, latent_dims) -> images
+        - only weights of blocks up to scale_idx are included """
+
+    module = tf.Module()
+    module.latent_dims = tf.Variable(latent_dims, trainable=False)
+    module.generator_weights = [weight for key, weight in get_weight_dict(generator).items() if int(key.split('/')[0]) <= scale_idx]
+
+    generator.alpha = None
+    module.sample = tf.function(
+        lambda latent_noise: generator(latent_noise, scale_idx, training=False),
+        input_signature=[tf.TensorSpec([None, latent_dims], tf.float32)])
+
+    tf.saved_model.save(module, save_path, signatures={"serving_default": module.sample})
+
+
+class Sampler:
+
+    """ Streams images from a generator exported by export_generator
+        - model_path: SavedModel directory for one scale """
+
+    def __init__(self, model_path):
+        self.model = tf.saved_model.load(model_path)
+        self.latent_dims = int(self.model.latent_dims.numpy())
+
+    def sample(self, n, batch_size=64, seed=None):
+        """ Yields n images in [-1, 1] as numpy arrays in chunks of batch_size
+            - seed: fixes latent noise for reproducible samples """
+
+        if seed is None:
+            rng = tf.random.Generator.from_non_deterministic_state()
+        else:
+            rng = tf.random.Generator.from_seed(seed)
+
+        for start in range(0, n, batch_size):
+            latent_noise = rng.normal([np.min([batch_size, n - start]), self.latent_dims])
+
+            yield self.model.sample(latent_noise).numpy()
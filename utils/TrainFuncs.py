@@ -17,6 +17,149 @@ class WeightClipConstraint(keras.constraints.Constraint):
         return {"clip_value": self.clip_val}
 
 
+def get_weight_dict(model):
+    """ Returns dict of model weights keyed by block index,
+        layer attribute and weight name e.g. '2/conv1/kernel',
+        so equivalent weights in separate instances share keys
+        - model: Generator or Discriminator """
+
+    weight_dict = {}
+
+    for i, block in enumerate(model.blocks):
+        for name, layer in vars(block).items():
+            # Skip private attributes
+            if name.startswith('_'):
+                continue
+
+            if not isinstance(layer, keras.layers.Layer):
+                continue
+
+            for weight in layer.weights:
+                weight_name = weight.name.split('/')[-1].split(':')[0]
+                weight_dict[f"{i}/{name}/{weight_name}"] = weight
+
+    return weight_dict
+
+
+class EMA:
+
+    """ Exponential moving average of model weights
+        - source: model being trained
+        - target: model holding averaged weights
+        - beta: decay per training step
+        - every: number of training steps between updates """
+
+    def __init__(self, source, target, beta, every=1):
+        self.source = source
+        self.target = target
+        self.every = every
+
+        # Decay is compounded to account for skipped steps
+        self.beta = beta ** every
+        self.step = tf.Variable(0, dtype=tf.int32, trainable=False)
+
+        # Keys of weights already cloned from source
+        self.copied = set()
+
+    def get_pairs(self, trainable_only=True):
+        """ Returns list of (source, target) weights paired by key """
+
+        source_dict = get_weight_dict(self.source)
+        target_dict = get_weight_dict(self.target)
+        assert source_dict.keys() == target_dict.keys(), "Source and target weights do not match"
+
+        if trainable_only:
+            trainable = {w.ref() for w in self.target.trainable_weights}
+            return [(source_dict[k], target_dict[k]) for k in target_dict.keys() if target_dict[k].ref() in trainable]
+        else:
+            return [(source_dict[k], target_dict[k]) for k in target_dict.keys()]
+
+    def copy(self):
+        """ Copies source weights into target for weights not previously
+            copied i.e. all weights on first use, then any built since """
+
+        source_dict = get_weight_dict(self.source)
+        target_dict = get_weight_dict(self.target)
+        keys = [k for k in target_dict.keys() if k not in self.copied]
+        self.copied.update(keys)
+
+        return tf.group([target_dict[k].assign(source_dict[k]) for k in keys])
+
+    def apply(self):
+        """ Updates all trainable target weights as one grouped op
+            i.e. target -= (1 - beta) * (target - source) """
+
+        updates = [t.assign_sub((1 - self.beta) * (t - s)) for s, t in self.get_pairs()]
+
+        with tf.control_dependencies(updates):
+            return tf.constant(True)
+
+    def update(self):
+        """ Increments step and applies update every N steps,
+            returns whether the update was applied """
+
+        self.step.assign_add(1)
+
+        if self.every == 1:
+            return self.apply()
+
+        return tf.cond(self.step % self.every == 0, self.apply, lambda: tf.constant(False))
+
+
+class ADA:
+
+    """ Adaptive discriminator augmentation controller
+        https://arxiv.org/abs/2006.06676
+        - p: augmentation probability variable e.g. DiffAug.p
+        - target: target value of overfitting heuristic r = E[sign(D(real))]
+        - every: number of training steps between adjustments of p
+        - speed: number of real images over which p can change from 0 to 1 """
+
+    def __init__(self, p, target=0.6, every=4, speed=500000):
+        self.p = p
+        self.target = target
+        self.every = every
+        self.speed = speed
+        self.step = tf.Variable(0, dtype=tf.int32, trainable=False)
+
+        # Summed across replicas if distributed
+        self.sign_sum = tf.Variable(0.0, trainable=False, aggregation=tf.VariableAggregation.SUM)
+        self.count = tf.Variable(0.0, trainable=False, aggregation=tf.VariableAggregation.SUM)
+
+    @staticmethod
+    def sign_stats(realness):
+        """ Returns [sum of signs, count] of critic predictions for real
+            images, oriented so that positive means predicted real """
+
+        return tf.stack([tf.reduce_sum(tf.sign(realness)), tf.cast(tf.size(realness), tf.float32)])
+
+    def accumulate(self, stats):
+        """ Accumulates [sum of signs, count] from sign_stats - SUM aggregated
+            updates need a merge_call if distributed, so this must not be
+            called inside a graph loop """
+
+        self.sign_sum.assign_add(stats[0])
+        self.count.assign_add(stats[1])
+
+    def adjust(self):
+        """ Steps p towards target by number of images seen since last adjustment """
+
+        r = self.sign_sum / tf.maximum(self.count, 1.0)
+        self.p.assign(tf.clip_by_value(self.p + tf.sign(r - self.target) * self.count / self.speed, 0.0, 1.0))
+        self.sign_sum.assign(0.0)
+        self.count.assign(0.0)
+
+        return tf.constant(True)
+
+    def update(self):
+        """ Increments step and adjusts p every N steps,
+            returns whether p was adjusted """
+
+        self.step.assign_add(1)
+
+        return tf.cond(self.step % self.every == 0, self.adjust, lambda: tf.constant(False))
+
+
 @tf.function
 def least_square_loss(labels, predictions):
     """ Implements least square loss for LSGAN """
@@ -38,11 +181,12 @@ def wasserstein_loss(labels, predictions):
 
 
 @tf.function
-def gradient_penalty(real_img, fake_img, D, scale):
+def gradient_penalty(real_img, fake_img, D, scale, loss_scale=None):
 
     """ Implements gradient penalty for WGAN-GP
         - Takes real and fake images
-        - D: discriminator/critic """
+        - D: discriminator/critic
+        - loss_scale: if float16, current loss scale of critic optimiser """
 
     epsilon = tf.random.uniform([fake_img.shape[0], 1, 1, 1], 0.0, 1.0)
     x_hat = (epsilon * real_img) + ((1 - epsilon) * fake_img)
@@ -50,9 +194,21 @@ def gradient_penalty(real_img, fake_img, D, scale):
     with tf.GradientTape() as tape:
         tape.watch(x_hat)
         D_hat = D(x_hat, scale, training=True)
+        if loss_scale is not None: D_hat *= tf.cast(loss_scale, D_hat.dtype)
     
     gradients = tape.gradient(D_hat, x_hat)
+
+    return penalty_from_gradients(gradients, loss_scale)
+
+
+def penalty_from_gradients(gradients, loss_scale=None):
+    """ Gradient penalty from critic gradients w.r.t. interpolated images
+        - loss_scale: critic output was multiplied by loss_scale before taking
+          gradients, so float16 per-pixel gradients don't underflow """
+
+    gradients = tf.cast(gradients, tf.float32)
+    if loss_scale is not None: gradients /= tf.cast(loss_scale, tf.float32)
     grad_norm = tf.sqrt(tf.reduce_sum(tf.square(gradients), axis=(1, 2)))
     grad_penalty = tf.reduce_mean(tf.square(grad_norm - 1))
 
-    return grad_penalty
\ No newline at end of file
+    return grad_penalty